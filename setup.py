@@ -22,6 +22,7 @@ setup(
     license='MIT',
     package_dir={'': 'src'},
     packages=find_packages('src'),
+    py_modules=['presence_gevent'],
     include_package_data=True,
     zip_safe=False,
     install_requires=[
@@ -35,5 +36,9 @@ setup(
     [paste.app_factory]
     main = presence_analyzer.script:make_app
     debug = presence_analyzer.script:make_debug
+
+    [paste.server_factory]
+    gevent = presence_gevent:make_server
+    prefork = presence_analyzer.script:make_prefork_server
     """,
 )
@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 from .main import app
 from . import views
+from .storage import init_db
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Fingerprinted, precompressed static assets.
+
+`bin/flask-ctl assets` copies static files into DIST_DIR under names
+containing hash of their content, writes gzipped siblings of text files
+and a manifest mapping original names to fingerprinted ones. Pages link
+assets through asset_url(), falling back to plain static urls until
+assets are built.
+"""
+
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import mimetypes
+
+from flask import request, url_for, send_from_directory
+
+from presence_analyzer.main import app
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# static files fingerprinted by build()
+ASSETS = (
+    'css/normalize.css',
+    'css/style.css',
+    'js/jquery.min.js',
+    'img/loading.gif',
+)
+COMPRESSED_EXTENSIONS = ('.css', '.js', '.svg', '.html', '.json')
+
+DIST_DIR = 'dist'
+MANIFEST_FILE = 'manifest.json'
+
+# fingerprinted files never change, clients may cache them forever
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+MANIFEST = {'signature': None, 'assets': {}}
+
+
+def dist_path(*parts):
+    """
+    Returns path inside directory with built assets.
+    """
+    return os.path.join(app.static_folder, DIST_DIR, *parts)
+
+
+def fingerprint(filename, content):
+    """
+    Returns filename with short content hash inserted before extension.
+    """
+    root, ext = os.path.splitext(filename)
+    return '%s.%s%s' % (root, hashlib.md5(content).hexdigest()[:12], ext)
+
+
+def write_gzip(path, content):
+    """
+    Writes gzipped content next to path. Output does not depend on
+    build time, so rebuilding unchanged assets gives identical files.
+    """
+    with open(path + '.gz', 'wb') as raw:
+        with gzip.GzipFile(os.path.basename(path), 'wb', 9, raw, 0) as gz:
+            gz.write(content)
+
+
+def build(assets=ASSETS):
+    """
+    Writes fingerprinted copies of assets with their gzipped variants
+    and manifest into DIST_DIR. Returns the manifest.
+    """
+    if os.path.isdir(dist_path()):
+        shutil.rmtree(dist_path())
+
+    manifest = {}
+    for filename in assets:
+        with open(os.path.join(app.static_folder, filename), 'rb') as source:
+            content = source.read()
+        built = fingerprint(filename, content)
+        path = dist_path(built)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as target:
+            target.write(content)
+        if filename.endswith(COMPRESSED_EXTENSIONS):
+            write_gzip(path, content)
+        manifest[filename] = built
+
+    with open(dist_path(MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    log.info('Built %d assets into %s', len(manifest), dist_path())
+    return manifest
+
+
+def get_manifest():
+    """
+    Returns manifest of built assets, reloaded whenever it changes.
+    Empty if assets are not built.
+    """
+    try:
+        stat = os.stat(dist_path(MANIFEST_FILE))
+    except OSError:
+        return {}
+    signature = (stat.st_mtime, stat.st_size)
+    if MANIFEST['signature'] != signature:
+        with open(dist_path(MANIFEST_FILE), 'r') as manifest_file:
+            MANIFEST['assets'] = json.load(manifest_file)
+        MANIFEST['signature'] = signature
+    return MANIFEST['assets']
+
+
+def asset_url(filename):
+    """
+    Returns url of fingerprinted asset, or static url if it is not built.
+    """
+    built = get_manifest().get(filename)
+    if built is None:
+        return url_for('static', filename=filename)
+    return url_for('asset_view', filename=built)
+
+
+def send_asset(filename):
+    """
+    Sends built asset with far-future caching headers, gzipped variant
+    to clients accepting it.
+    """
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    if request.accept_encodings['gzip'] and \
+            os.path.isfile(dist_path(filename + '.gz')):
+        encoding = 'gzip'
+        filename += '.gz'
+
+    response = send_from_directory(
+        dist_path(), filename, mimetype=mimetype, cache_timeout=31536000,
+    )
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = ASSET_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
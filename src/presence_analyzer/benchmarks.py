@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of presence data loading.
+"""
+
+import csv
+import time
+
+from presence_analyzer.utils import parse_csv, parse_row, open_data_file, \
+    new_report, validate_row
+
+
+def best_time(func, repeat):
+    """
+    Returns the shortest of `repeat` timings of func call.
+    """
+    timings = []
+    for _ in xrange(repeat):
+        started = time.time()
+        func()
+        timings.append(time.time() - started)
+    return min(timings)
+
+
+def read_rows(path):
+    """
+    Returns parsed rows of CSV file, skipping invalid ones.
+    """
+    rows = []
+    with open_data_file(path) as csvfile:
+        for row in csv.reader(csvfile):
+            try:
+                rows.append(parse_row(row))
+            except (ValueError, TypeError, IndexError):
+                continue
+    return rows
+
+
+def bench_validation(path, repeat=3):
+    """
+    Measures per-row cost of parsing CSV file and of validation stage alone.
+
+    Returns dict with number of rows and costs in microseconds.
+    """
+    rows = read_rows(path)
+    count = len(rows) or 1
+
+    def _validate():
+        report = new_report()
+        data = {}
+        for line, (user_id, date, start, end) in enumerate(rows, 1):
+            items = data.setdefault(user_id, {})
+            if validate_row(report, items, line, date, start, end):
+                items[date] = {'start': start, 'end': end}
+
+    return {
+        'rows': len(rows),
+        'parse': best_time(
+            lambda: parse_csv(path, validate=False), repeat
+        ) / count * 1e6,
+        'parse_validate': best_time(
+            lambda: parse_csv(path, validate=True), repeat
+        ) / count * 1e6,
+        'validation': best_time(_validate, repeat) / count * 1e6,
+    }
+
+
+def report(path, repeat=3):
+    """
+    Runs loading benchmarks and prints results.
+    """
+    result = bench_validation(path, repeat)
+    print 'Parsing %s (%d rows, best of %d)' % (path, result['rows'], repeat)
+    for name, key in (
+            ('parse', 'parse'),
+            ('parse + validation', 'parse_validate'),
+            ('validation stage', 'validation')):
+        print '%-24s %8.2f us/row' % (name, result[key])
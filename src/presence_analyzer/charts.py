@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Chart-ready Google DataTable payloads built on server side.
+"""
+
+import calendar
+from datetime import date
+
+from presence_analyzer.utils import mean, interval, memorize_per_version
+from presence_analyzer.storage import get_storage, storage_version
+
+# chart name: (DataTable columns, function building rows)
+CHARTS = {}
+
+# downsampled series keep at least first, last and one middle point
+MIN_POINTS = 3
+
+
+def chart(name, columns):
+    """
+    Registers function returning rows of named chart.
+    """
+    def _register(func):
+        CHARTS[name] = (columns, func)
+        return func
+    return _register
+
+
+def column(label, type_, id_=None):
+    """
+    Returns DataTable column description.
+    """
+    return {'id': id_ or label, 'label': label, 'type': type_}
+
+
+def time_of_day(seconds):
+    """
+    Converts amount of seconds since midnight into timeofday cell value.
+    """
+    seconds = int(round(seconds))
+    return [seconds // 3600, seconds % 3600 // 60, seconds % 60]
+
+
+def datetime_value(seconds):
+    """
+    Converts amount of seconds since midnight into datetime cell value.
+    """
+    hours, minutes, seconds = time_of_day(seconds)
+    return 'Date(1970, 0, 1, %d, %d, %d)' % (hours, minutes, seconds)
+
+
+def date_value(date):
+    """
+    Converts datetime.date into date cell value.
+    """
+    return 'Date(%d, %d, %d)' % (date.year, date.month - 1, date.day)
+
+
+def downsample(points, threshold):
+    """
+    Reduces list of (x, y) points to `threshold` points using
+    Largest-Triangle-Three-Buckets, which keeps visual shape of series.
+    Threshold below MIN_POINTS is raised to it, first and last points
+    are always kept.
+    """
+    threshold = max(threshold, MIN_POINTS)
+    if threshold >= len(points):
+        return points
+
+    sampled = [points[0]]
+    bucket_size = float(len(points) - 2) / (threshold - 2)
+    selected = 0
+    for i in xrange(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, len(points))
+        next_bucket = points[end:next_end] or [points[-1]]
+        avg_x = mean([x for x, _ in next_bucket])
+        avg_y = mean([y for _, y in next_bucket])
+
+        ax, ay = points[selected]
+        best_area = -1
+        for j in xrange(start, end):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                selected = j
+        sampled.append(points[selected])
+
+    sampled.append(points[-1])
+    return sampled
+
+
+@chart('presence_weekday', [
+    column('Weekday', 'string'),
+    column('Presence (s)', 'number'),
+])
+def presence_weekday_rows(storage, user_id, points):
+    """
+    Total presence time grouped by weekday.
+    """
+    weekdays = storage.weekday_intervals(user_id)
+    return [
+        [calendar.day_abbr[weekday], sum(intervals)]
+        for weekday, intervals in weekdays.items()
+    ]
+
+
+@chart('mean_time_weekday', [
+    column('Weekday', 'string'),
+    column('Mean time (h:m:s)', 'timeofday'),
+])
+def mean_time_weekday_rows(storage, user_id, points):
+    """
+    Mean presence time grouped by weekday.
+    """
+    weekdays = storage.weekday_intervals(user_id)
+    return [
+        [calendar.day_abbr[weekday], time_of_day(mean(intervals))]
+        for weekday, intervals in weekdays.items()
+    ]
+
+
+@chart('presence_start_end', [
+    column('Weekday', 'string'),
+    column('Start', 'datetime'),
+    column('End', 'datetime'),
+])
+def presence_start_end_rows(storage, user_id, points):
+    """
+    Mean start and end times grouped by weekday.
+    """
+    weekdays = storage.weekday_start_end(user_id)
+    return [
+        [
+            calendar.day_abbr[weekday],
+            datetime_value(mean(times['starts'])),
+            datetime_value(mean(times['ends'])),
+        ]
+        for weekday, times in weekdays.items()
+    ]
+
+
+@chart('presence_daily', [
+    column('Date', 'date'),
+    column('Presence (s)', 'number'),
+])
+def presence_daily_rows(storage, user_id, points):
+    """
+    Presence time of every day, downsampled to `points` days.
+    """
+    items = storage.user_rows(user_id)
+    series = [
+        (day.toordinal(), interval(items[day]['start'], items[day]['end']))
+        for day in sorted(items)
+    ]
+    if points:
+        series = downsample(series, points)
+    return [
+        [date_value(date.fromordinal(ordinal)), seconds]
+        for ordinal, seconds in series
+    ]
+
+
+@memorize_per_version(storage_version)
+def chart_table(name, user_id, points=None):
+    """
+    Returns DataTable of named chart for given user, empty rows
+    if user has no presence data. Raises KeyError for unknown charts.
+    """
+    columns, rows_func = CHARTS[name]
+    storage = get_storage()
+    rows = []
+    if storage.has_user(user_id):
+        rows = rows_func(storage, user_id, points)
+    return {
+        'cols': columns,
+        'rows': [{'c': [{'v': value} for value in row]} for row in rows],
+    }
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Simple HTTP load test used to compare serving modes.
+"""
+
+import time
+import urllib2
+import threading
+
+
+def percentile(values, percent):
+    """
+    Returns percentile of sorted list of values. Zero for empty lists.
+    """
+    if not values:
+        return 0
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def fetch(url, count, latencies, errors):
+    """
+    Requests url `count` times, collecting latencies of successful calls.
+    """
+    for _ in xrange(count):
+        started = time.time()
+        try:
+            urllib2.urlopen(url).read()
+        except (urllib2.URLError, IOError):
+            errors.append(url)
+            continue
+        latencies.append(time.time() - started)
+
+
+def run(url, concurrency, requests):
+    """
+    Sends `requests` requests to url from `concurrency` client threads.
+
+    Returns dict with p50 and p99 latency in milliseconds,
+    requests per second and number of failed requests.
+    """
+    latencies = []
+    errors = []
+    per_client = max(requests // concurrency, 1)
+    clients = [
+        threading.Thread(
+            target=fetch, args=(url, per_client, latencies, errors)
+        )
+        for _ in xrange(concurrency)
+    ]
+    started = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'rps': len(latencies) / elapsed if elapsed else 0,
+        'errors': len(errors),
+    }
+
+
+def report(url, concurrencies, requests):
+    """
+    Runs load test for every concurrency level and prints results.
+    """
+    print 'Load test of %s' % url
+    print '%12s %10s %10s %10s %8s' % (
+        'concurrency', 'p50 (ms)', 'p99 (ms)', 'req/s', 'errors',
+    )
+    for concurrency in concurrencies:
+        result = run(url, concurrency, requests)
+        print '%(concurrency)12d %(p50)10.1f %(p99)10.1f %(rps)10.1f ' \
+            '%(errors)8d' % result
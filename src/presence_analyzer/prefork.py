@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-fork multi-process server.
+
+Master process loads presence data once and forks workers sharing it
+copy-on-write. Workers accept connections on the socket bound by master.
+"""
+
+import os
+import time
+import errno
+import signal
+
+from werkzeug.serving import BaseWSGIServer
+
+from presence_analyzer import utils, storage, warmup
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# memorized data loaded by master and shared with workers
+SHARED_KEYS = ('get_data', 'get_user_data')
+
+
+class PreforkServer(object):
+    """
+    Master of pre-forked WSGI workers.
+
+    SIGHUP reloads data and replaces workers one by one, SIGTERM and
+    SIGINT stop all workers. Data is also reloaded every
+    `reload_interval` seconds if any of data files changed.
+    """
+
+    def __init__(self, app, host, port, workers, reload_interval):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.reload_interval = reload_interval
+        self.server = None
+        self.children = set()
+        self.signature = None
+        self.reload_requested = False
+        self.alive = True
+
+    def run(self):
+        """
+        Binds socket, loads data, forks workers and supervises them.
+        """
+        self.server = BaseWSGIServer(self.host, self.port, self.app)
+        self.server.timeout = 1
+        self.load()
+        for _ in range(self.workers):
+            self.spawn()
+
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        log.info('Serving on http://%s:%s with %d workers',
+                 self.host, self.port, self.workers)
+
+        next_check = time.time() + self.reload_interval
+        while self.alive:
+            self.reap()
+            if time.time() >= next_check:
+                next_check = time.time() + self.reload_interval
+                self.check()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.safe_reload()
+            time.sleep(1)
+
+        self.stop()
+
+    def check(self):
+        """
+        Requests reload if source of data changed since last load.
+        """
+        try:
+            signature = storage.get_storage().signature()
+        except Exception:  # pylint: disable-msg=W0703
+            # e.g. data file removed while being rotated
+            log.exception('Checking presence data failed')
+            return
+        if signature != self.signature:
+            self.reload_requested = True
+
+    def safe_reload(self):
+        """
+        Reloads data, keeping current workers if it fails. Signature
+        of loaded data is left unchanged then, so reload is retried
+        on next check.
+        """
+        try:
+            self.reload()
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Presence data reload failed, keeping workers')
+
+    def load(self):
+        """
+        Loads presence and user data into memorized cache of master
+        and warms up responses of most requested users.
+        """
+        signature = storage.get_storage().signature()
+        # master has no other threads, data files may be parsed in pool
+        utils.PARALLEL_LOAD['enabled'] = True
+        try:
+            storage.refresh_storage()
+        finally:
+            utils.PARALLEL_LOAD['enabled'] = False
+        try:
+            utils.get_user_data.refresh()
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Loading user data failed')
+        warmup.warm_up()
+        for key in SHARED_KEYS:
+            utils.pin_cache(key)
+        # workers open their own SQLite connections
+        storage.close_storages()
+        self.signature = signature
+
+    def spawn(self):
+        """
+        Forks new worker serving requests until SIGTERM.
+        """
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+
+        # worker
+        storage.STORAGES.clear()
+        state = {'alive': True}
+
+        def _stop(signum, frame):  # pylint: disable-msg=W0613
+            state['alive'] = False
+
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, _stop)
+        try:
+            while state['alive']:
+                try:
+                    self.server.handle_request()
+                except EnvironmentError as error:
+                    if error.errno != errno.EINTR:
+                        raise
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Worker %d failed', os.getpid())
+        finally:
+            os._exit(0)  # pylint: disable-msg=W0212
+
+    def reap(self):
+        """
+        Collects exited workers and replaces them.
+        """
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if pid in self.children:
+                self.children.discard(pid)
+                log.warning('Worker %d exited, spawning new one', pid)
+                self.spawn()
+
+    def reload(self):
+        """
+        Reloads data and gracefully replaces workers one at a time.
+        """
+        started = time.time()
+        self.load()
+        for pid in list(self.children):
+            self.spawn()
+            self.children.discard(pid)
+            self.kill(pid)
+        log.info('Reloaded %d workers in %.2fs',
+                 self.workers, time.time() - started)
+
+    def kill(self, pid):
+        """
+        Asks worker to finish current request and waits for it to exit.
+        """
+        self.terminate(pid)
+        self.wait(pid)
+
+    @staticmethod
+    def terminate(pid):
+        """
+        Sends SIGTERM to worker.
+        """
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as error:
+            if error.errno != errno.ESRCH:
+                raise
+
+    @staticmethod
+    def wait(pid):
+        """
+        Waits for worker to exit.
+        """
+        while True:
+            try:
+                os.waitpid(pid, 0)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                if error.errno != errno.ECHILD:
+                    raise
+            return
+
+    def stop(self):
+        """
+        Stops all workers and closes listening socket.
+        """
+        children, self.children = self.children, set()
+        for pid in children:
+            self.terminate(pid)
+        for pid in children:
+            self.wait(pid)
+        self.server.server_close()
+
+    def handle_reload(self, signum, frame):  # pylint: disable-msg=W0613
+        """
+        SIGHUP handler.
+        """
+        self.reload_requested = True
+
+    def handle_stop(self, signum, frame):  # pylint: disable-msg=W0613
+        """
+        SIGTERM and SIGINT handler.
+        """
+        self.alive = False
@@ -25,26 +25,88 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, warmup=True):
+    """Configures the application.
+
+    With `warmup` templates are compiled and data is loaded and kept
+    fresh in background, as needed for serving. Commands not serving
+    requests (shell, initdb) pass False.
+    """
+    from presence_analyzer import app, views
+    from presence_analyzer.warmup import BACKGROUND, start
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if not warmup:
+        return app
+    # compile templates once, before workers fork or take requests
+    views.precompile_templates()
+    if BACKGROUND['enabled']:
+        # load data (and cache responses) before reporting readiness
+        start(app.config.get('DATA_RELOAD_INTERVAL', 25))
     return app
 
 
 # bin/paster serve parts/etc/debug.ini
-def make_debug(global_conf={}, **conf):
+def make_debug(global_conf={}, warmup=True, **conf):
     from werkzeug.debug import DebuggedApplication
-    app = make_app(global_conf, config=DEBUG_CFG, debug=True)
+    app = make_app(global_conf, config=DEBUG_CFG, debug=True, warmup=warmup)
     return DebuggedApplication(app, evalex=True)
 
 
+# [server:gevent] in parts/etc/deploy.ini
+def make_gevent_server(global_conf={}, host='0.0.0.0', port=8081,
+                       spawn=1000, reload_interval=25):
+    """Paste server factory serving the application with gevent.
+
+    Used through presence_gevent.make_server, which monkey patches
+    before presence_analyzer package gets imported.
+    """
+    from gevent import get_hub
+    from gevent.pywsgi import WSGIServer
+    from presence_analyzer import warmup
+    # warm-up and reloader are started by serve, loading in threadpool
+    warmup.BACKGROUND['enabled'] = False
+
+    def serve(app):
+        from presence_analyzer import storage
+
+        def refresh():
+            # warm-up and reloader are greenlets, parse data in a real OS
+            # thread so the event loop keeps serving requests meanwhile
+            get_hub().threadpool.apply(storage.refresh_storage)
+
+        warmup.start(int(reload_interval), refresh)
+        server = WSGIServer((host, int(port)), app, spawn=int(spawn))
+        print 'Serving with gevent on http://%s:%s' % (host, port)
+        server.serve_forever()
+    return serve
+
+
+# [server:prefork] in parts/etc/deploy.ini
+def make_prefork_server(global_conf={}, host='0.0.0.0', port=8081,
+                        workers=2, reload_interval=25):
+    """Paste server factory serving the application with forked workers."""
+    from presence_analyzer import warmup
+    # master warms up on its own before forking, see PreforkServer.load
+    warmup.BACKGROUND['enabled'] = False
+    # bin/flask-ctl serve --workers N passes prefork_workers=N
+    workers = int(global_conf.get('prefork_workers') or workers)
+
+    def serve(app):
+        from presence_analyzer.prefork import PreforkServer
+        server = PreforkServer(
+            app, host, int(port), workers, int(reload_interval)
+        )
+        server.run()
+    return serve
+
+
 # bin/flask-ctl shell
 def make_shell():
     """Interactive Flask Shell"""
     from flask import request
     from presence_analyzer import init_db as initdb
-    app = make_app()
+    app = make_app(warmup=False)
     http = app.test_client()
     reqctx = app.test_request_context
     return locals()
@@ -78,15 +140,15 @@ def _init_db(debug=False, dry_run=False):
         return
     # Configure the application
     if debug:
-        make_debug()
+        make_debug(warmup=False)
     else:
-        make_app()
+        make_app(warmup=False)
     # Create the tables
     init_db()
 
 
-def _serve(action, debug=False, dry_run=False):
-    """Build paster command from 'action' and 'debug' flag."""
+def _serve(action, debug=False, dry_run=False, server='main', workers=0):
+    """Build paster command from 'action', 'debug' and 'server' flags."""
     if action == 'initdb':
         # First, create the tables
         return _init_db(debug=debug, dry_run=dry_run)
@@ -101,6 +163,10 @@ def _serve(action, debug=False, dry_run=False):
         argv += ['--reload']
     else:
         argv += [action]
+    if workers:
+        server = 'prefork'
+    if server != 'main':
+        argv += ['--server-name', server]
     # Print the 'paster' command
     print ' '.join(argv)
     if dry_run:
@@ -111,7 +177,13 @@ def _serve(action, debug=False, dry_run=False):
             '--log-file', abspath('var', 'log', 'paster.log'),
             '--pid-file', abspath('var', 'log', '.paster.pid'),
         ]
+    if workers:
+        argv += ['prefork_workers=%d' % workers]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
+    if server == 'gevent':
+        # this process already imported the application unpatched,
+        # run paster afresh so gevent patches before importing it
+        os.execv(abspath('bin', 'paster'), sys.argv)
     # Run the 'paster' command
     paste.script.command.run()
 
@@ -122,7 +194,8 @@ def run():
     action_xml = make_xml
 
     # bin/flask-ctl serve [fg|start|stop|restart|status|initdb]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    def action_serve(action=('a', 'start'), dry_run=False,
+                     server=('s', 'main'), workers=('w', 0)):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
@@ -131,13 +204,51 @@ def run():
         Options:
          - 'action' is one of [fg|start|stop|restart|status|initdb]
          - '--dry-run' print the paster command and exit
+         - '--server' is one of [main|gevent|prefork], 'main' is Paste
+           threadpool
+         - '--workers' number of forked processes, implies prefork server
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        _serve(action, debug=False, dry_run=dry_run, server=server,
+               workers=workers)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status|initdb]
-    def action_debug(action=('a', 'start'), dry_run=False):
+    def action_debug(action=('a', 'start'), dry_run=False,
+                     server=('s', 'main'), workers=('w', 0)):
         """Serve the debugging application."""
-        _serve(action, debug=True, dry_run=dry_run)
+        _serve(action, debug=True, dry_run=dry_run, server=server,
+               workers=workers)
+
+    # bin/flask-ctl assets
+    def action_assets():
+        """Build fingerprinted and gzipped static assets.
+
+        Files are written into static/dist and served from /assets/
+        with far-future caching headers. Rebuild after changing any
+        static file.
+        """
+        from presence_analyzer import assets
+        manifest = assets.build()
+        for filename in sorted(manifest):
+            print '%s -> %s' % (filename, manifest[filename])
+
+    # bin/flask-ctl bench -p runtime/data/sample_data.csv
+    def action_bench(path=('p', 'runtime/data/sample_data.csv'),
+                     repeat=('r', 3)):
+        """Measure per-row cost of CSV parsing and validation."""
+        from presence_analyzer import benchmarks
+        benchmarks.report(abspath(path), repeat)
+
+    # bin/flask-ctl loadtest -u URL -c 10,100 -n 1000
+    def action_loadtest(url=('u', 'http://localhost:8081/api/v1/users'),
+                        concurrency=('c', '10,100'), requests=('n', 1000)):
+        """Measure p50/p99 latency and req/s of running server.
+
+        Start the server with '--server main' and '--server gevent'
+        in turn and run this command against each of them.
+        """
+        from presence_analyzer import loadtest
+        concurrencies = [int(c) for c in concurrency.split(',')]
+        loadtest.report(url, concurrencies, requests)
 
     # bin/flask-ctl status
     def action_status(dry_run=False):
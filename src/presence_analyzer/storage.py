@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data storage backends.
+"""
+
+import os
+import sqlite3
+import threading
+from datetime import datetime, time
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import get_data, data_version, get_rollups, \
+    data_signature, data_stats, build_rollups, group_by_weekday, \
+    group_by_weekday_start_end, seconds_since_midnight
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+STORAGES = {}
+
+
+class PresenceStorage(object):
+    """
+    Storage interface for presence data.
+
+    User rows are returned in the same shape as single user entry
+    of get_data(): {date: {'start': time, 'end': time}}.
+    """
+
+    def load(self):
+        """
+        Returns presence data of all users grouped by user_id.
+        """
+        raise NotImplementedError
+
+    def version(self):
+        """
+        Returns value changing whenever stored data changes.
+        """
+        raise NotImplementedError
+
+    def signature(self):
+        """
+        Returns value changing whenever source of data changes, cheap to
+        compute and never loading the data.
+        """
+        return self.version()
+
+    def refresh(self):
+        """
+        Reloads data kept in memory. Nothing to do for storages
+        querying their data on demand.
+        """
+
+    def stats(self):
+        """
+        Returns load state, version and counts of stored data, in shape
+        of utils.data_stats(). Must be cheap and never load the data.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases resources opened by current thread.
+        """
+
+    def users(self):
+        """
+        Returns list of ids of users having any presence entries.
+        """
+        raise NotImplementedError
+
+    def has_user(self, user_id):
+        """
+        Checks if user has any presence entries.
+        """
+        raise NotImplementedError
+
+    def user_rows(self, user_id):
+        """
+        Returns presence entries of given user.
+        """
+        raise NotImplementedError
+
+    def range(self, user_id, start=None, end=None):
+        """
+        Returns presence entries of given user between dates, inclusive.
+        """
+        return {
+            date: item
+            for date, item in self.user_rows(user_id).iteritems()
+            if (start is None or date >= start) and
+            (end is None or date <= end)
+        }
+
+    def weekday_intervals(self, user_id):
+        """
+        Returns presence intervals of given user grouped by weekday.
+        """
+        return group_by_weekday(self.user_rows(user_id))
+
+    def weekday_start_end(self, user_id):
+        """
+        Returns start and end times of given user grouped by weekday.
+        """
+        return group_by_weekday_start_end(self.user_rows(user_id))
+
+    def trend(self, user_id, period):
+        """
+        Returns presence of given user summed per week or month as sorted
+        list of (bucket key, seconds, days), see utils.build_rollups.
+        """
+        rollup = build_rollups({user_id: self.user_rows(user_id)})[user_id]
+        return sorted_buckets(rollup[period])
+
+
+class CSVStorage(PresenceStorage):
+    """
+    Storage reading presence data from CSV files into memory.
+    """
+
+    def load(self):
+        return get_data()
+
+    def version(self):
+        get_data()
+        return data_version()
+
+    def signature(self):
+        return data_signature()
+
+    def refresh(self):
+        get_data.refresh()
+
+    def stats(self):
+        return data_stats()
+
+    def users(self):
+        return list(get_data())
+
+    def has_user(self, user_id):
+        return user_id in get_data()
+
+    def user_rows(self, user_id):
+        return get_data().get(user_id, {})
+
+    def trend(self, user_id, period):
+        rollups = get_rollups()
+        if rollups is None:
+            # lazily loaded data has no rollups, sum decoded user rows
+            return super(CSVStorage, self).trend(user_id, period)
+        if user_id not in rollups:
+            return []
+        return sorted_buckets(rollups[user_id][period])
+
+
+class SQLiteStorage(PresenceStorage):
+    """
+    Storage querying presence data from SQLite database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        """
+        Returns SQLite connection of current thread.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            self.local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def create_tables(self):
+        """
+        Creates presence table unless it exists.
+        """
+        with self.connection as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS presence ('
+                'user_id INTEGER NOT NULL, '
+                'date TEXT NOT NULL, '
+                'start_time INTEGER NOT NULL, '
+                'end_time INTEGER NOT NULL, '
+                'PRIMARY KEY (user_id, date))'
+            )
+
+    def import_data(self, data):
+        """
+        Replaces stored presence entries with given get_data() structure.
+        """
+        rows = (
+            (
+                user_id,
+                date.isoformat(),
+                seconds_since_midnight(item['start']),
+                seconds_since_midnight(item['end']),
+            )
+            for user_id in data
+            for date, item in data[user_id].iteritems()
+        )
+        with self.connection as connection:
+            connection.execute('DELETE FROM presence')
+            connection.executemany(
+                'INSERT INTO presence VALUES (?, ?, ?, ?)', rows
+            )
+
+    def query(self, sql, *args):
+        """
+        Executes query and returns all fetched rows.
+        """
+        return self.connection.execute(sql, args).fetchall()
+
+    def version(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime, stat.st_size
+
+    def stats(self):
+        stats = dict.fromkeys((
+            'data_age', 'last_reload_duration', 'row_errors',
+            'last_check_age',
+        ))
+        try:
+            version = self.version()
+            users, rows = self.query(
+                'SELECT COUNT(DISTINCT user_id), COUNT(*) FROM presence'
+            )[0]
+        except (OSError, sqlite3.Error) as error:
+            stats.update({
+                'state': 'failed',
+                'data_version': None,
+                'data_modified': None,
+                'files': None,
+                'users': None,
+                'rows': None,
+                'last_reload_error': repr(error),
+            })
+            return stats
+        stats.update({
+            'state': 'loaded',
+            'data_version': version,
+            'data_modified': version[0],
+            'files': 1,
+            'users': users,
+            'rows': rows,
+            'last_reload_error': None,
+        })
+        return stats
+
+    def load(self):
+        data = {}
+        rows = self.query(
+            'SELECT user_id, date, start_time, end_time FROM presence'
+        )
+        for user_id, date, start, end in rows:
+            data.setdefault(user_id, {})[to_date(date)] = {
+                'start': to_time(start),
+                'end': to_time(end),
+            }
+        return data
+
+    def users(self):
+        return [
+            user_id
+            for user_id, in self.query(
+                'SELECT DISTINCT user_id FROM presence ORDER BY user_id'
+            )
+        ]
+
+    def has_user(self, user_id):
+        return bool(self.query(
+            'SELECT 1 FROM presence WHERE user_id = ? LIMIT 1', user_id
+        ))
+
+    def user_rows(self, user_id):
+        return self.range(user_id)
+
+    def range(self, user_id, start=None, end=None):
+        rows = self.query(
+            'SELECT date, start_time, end_time FROM presence '
+            'WHERE user_id = ? AND date >= ? AND date <= ?',
+            user_id,
+            start.isoformat() if start is not None else '',
+            end.isoformat() if end is not None else '9999-12-31',
+        )
+        return {
+            to_date(date): {
+                'start': to_time(start_time),
+                'end': to_time(end_time),
+            }
+            for date, start_time, end_time in rows
+        }
+
+    def weekday_intervals(self, user_id):
+        result = {i: [] for i in range(7)}
+        rows = self.query(
+            "SELECT (CAST(strftime('%w', date) AS INTEGER) + 6) % 7, "
+            'end_time - start_time FROM presence WHERE user_id = ?',
+            user_id,
+        )
+        for weekday, seconds in rows:
+            result[weekday].append(seconds)
+        return result
+
+    def weekday_start_end(self, user_id):
+        result = {i: {'starts': [], 'ends': []} for i in range(7)}
+        rows = self.query(
+            "SELECT (CAST(strftime('%w', date) AS INTEGER) + 6) % 7, "
+            'start_time, end_time FROM presence WHERE user_id = ?',
+            user_id,
+        )
+        for weekday, start, end in rows:
+            result[weekday]['starts'].append(start)
+            result[weekday]['ends'].append(end)
+        return result
+
+    def trend(self, user_id, period):
+        if period == 'week':
+            # ISO week and its year are the ones of Thursday of that week
+            key = (
+                "strftime('%Y', date(date, '-3 days', 'weekday 4')) || '-W' "
+                "|| substr('0' || ((CAST(strftime('%j', "
+                "date(date, '-3 days', 'weekday 4')) AS INTEGER) - 1) "
+                "/ 7 + 1), -2)"
+            )
+        else:
+            key = "strftime('%Y-%m', date)"
+        return self.query(
+            'SELECT {0} AS bucket, SUM(end_time - start_time), COUNT(*) '
+            'FROM presence WHERE user_id = ? '
+            'GROUP BY bucket ORDER BY bucket'.format(key),
+            user_id,
+        )
+
+
+def sorted_buckets(buckets):
+    """
+    Converts rollup buckets into chronologically sorted list.
+    """
+    return [
+        (key, seconds, days)
+        for key, (seconds, days) in sorted(buckets.iteritems())
+    ]
+
+
+def to_date(value):
+    """
+    Converts ISO date string into datetime.date.
+    """
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def to_time(seconds):
+    """
+    Converts amount of seconds since midnight into datetime.time.
+    """
+    return time(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def get_storage():
+    """
+    Returns storage backend selected by STORAGE config option.
+    """
+    kind = app.config.get('STORAGE', 'csv')
+    if kind == 'csv':
+        key = (kind,)
+    elif kind == 'sqlite':
+        key = (kind, app.config['DATABASE'])
+    else:
+        raise ValueError('Unknown storage: %s' % kind)
+
+    storage = STORAGES.get(key)
+    if storage is None:
+        storage = CSVStorage() if kind == 'csv' else SQLiteStorage(key[1])
+        STORAGES[key] = storage
+    return storage
+
+
+def storage_version():
+    """
+    Returns version of data kept by selected storage backend.
+    """
+    return get_storage().version()
+
+
+def refresh_storage():
+    """
+    Reloads data kept in memory by selected storage backend.
+    """
+    get_storage().refresh()
+
+
+def close_storages():
+    """
+    Closes storages used by current thread. SQLite connections must not
+    be used across fork(), so it is called before forking workers.
+    """
+    for storage in STORAGES.values():
+        storage.close()
+
+
+def init_db():
+    """
+    Creates SQLite database and imports presence data from CSV files.
+    """
+    storage = SQLiteStorage(app.config['DATABASE'])
+    storage.create_tables()
+    storage.import_data(get_data())
+    log.info('Imported presence data into %s', storage.path)
@@ -3,11 +3,16 @@
 Presence analyzer unit tests.
 """
 import os.path
+import gzip
 import json
+import zlib
+import shutil
 import datetime
+import tempfile
 import unittest
 
-from presence_analyzer import main, utils
+from presence_analyzer import main, utils, storage, loadtest, warmup, \
+    benchmarks, charts, views, assets, prefork
 
 
 TEST_DATA_CSV = os.path.join(
@@ -76,6 +81,39 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         resp = self.client.get('/not_existing_page')
         self.assertEqual(resp.status_code, 404)
 
+    def test_precompile_templates(self):
+        """
+        Test compiling whitelisted templates into module directory.
+        """
+        self.assertEqual(views.TEMPLATES, frozenset([
+            'site_base',
+            'presence_weekday',
+            'mean_time_weekday',
+            'presence_start_end',
+        ]))
+
+        module_dir = tempfile.mkdtemp()
+        main.app.config['MAKO_MODULE_DIRECTORY'] = module_dir
+        try:
+            views.precompile_templates()
+            self.assertItemsEqual(
+                [name for name in os.listdir(module_dir)
+                 if name.endswith('.py')],
+                [name + '.html.py' for name in views.TEMPLATES],
+            )
+            module = os.path.join(module_dir, 'presence_weekday.html.py')
+            compiled = os.stat(module).st_ino
+            resp = self.client.get('/presence_weekday')
+            self.assertEqual(resp.status_code, 200)
+            # compiled module is not rewritten
+            self.assertEqual(os.stat(module).st_ino, compiled)
+        finally:
+            main.app.config['MAKO_MODULE_DIRECTORY'] = None
+            shutil.rmtree(module_dir)
+
+        # nothing to keep compiled templates in
+        views.precompile_templates()
+
     def test_api_users(self):
         """
         Test users listing.
@@ -102,6 +140,52 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             u'avatar': u'/api/images/users/141'
         })
         
+    def test_api_content_negotiation(self):
+        """
+        Test compressed and MessagePack API responses.
+        """
+        url = '/api/v1/presence_weekday/10'
+        plain = json.loads(self.client.get(url).data)
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+
+        main.app.config['RESPONSE_COMPRESS_MIN_SIZE'] = 0
+        try:
+            resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.content_type, 'application/json')
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(
+                json.loads(zlib.decompress(resp.data, 16 + zlib.MAX_WBITS)),
+                plain,
+            )
+            resp = self.client.get(url, headers={'Accept-Encoding': 'deflate'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'deflate')
+            self.assertEqual(json.loads(zlib.decompress(resp.data)), plain)
+        finally:
+            del main.app.config['RESPONSE_COMPRESS_MIN_SIZE']
+
+        if utils.msgpack is None:
+            return
+        resp = self.client.get(url, headers={
+            'Accept': 'application/x-msgpack',
+        })
+        self.assertEqual(resp.content_type, 'application/x-msgpack')
+        self.assertEqual(utils.msgpack.unpackb(resp.data, raw=False), plain)
+
+    def test_api_data_errors(self):
+        """
+        Test validation report api.
+        """
+        resp = self.client.get('/api/v1/data_errors')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data['rows'], 9)
+        self.assertEqual(data['errors']['malformed'], 0)
+        self.assertItemsEqual(data['samples'].keys(), utils.ROW_ERRORS)
+
     def test_api_presence_start_end(self):
         """
         Test user weekday presence start end
@@ -160,6 +244,184 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             [u'Sun', 0],
         ])
 
+    def test_api_presence_trend(self):
+        """
+        Test user presence summed per week and month api
+        """
+        resp = self.client.get('/api/v1/presence_trend/11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(json.loads(resp.data), [
+            [u'2013-W36', 22999, 1],
+            [u'2013-W37', 95403, 5],
+        ])
+        resp = self.client.get('/api/v1/presence_trend/11?period=month')
+        self.assertEqual(json.loads(resp.data), [[u'2013-09', 118402, 6]])
+        resp = self.client.get('/api/v1/presence_trend/11?start=2013-W37')
+        self.assertEqual(json.loads(resp.data), [[u'2013-W37', 95403, 5]])
+        resp = self.client.get('/api/v1/presence_trend/11?end=2013-W36')
+        self.assertEqual(json.loads(resp.data), [[u'2013-W36', 22999, 1]])
+        resp = self.client.get('/api/v1/presence_trend/12')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.client.get('/api/v1/presence_trend/11?period=year')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/presence_trend/11?start=2013-09')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(
+            '/api/v1/presence_trend/11?period=month&end=2013-W37'
+        )
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(
+            '/api/v1/presence_trend/11?period=month&start=2013-13'
+        )
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_chart(self):
+        """
+        Test chart data api returning Google DataTable.
+        """
+        resp = self.client.get('/api/v1/chart/presence_start_end/11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(
+            [col['type'] for col in data['cols']],
+            [u'string', u'datetime', u'datetime'],
+        )
+        self.assertEqual(len(data['rows']), 7)
+        self.assertEqual(data['rows'][0], {u'c': [
+            {u'v': u'Mon'},
+            {u'v': u'Date(1970, 0, 1, 9, 12, 14)'},
+            {u'v': u'Date(1970, 0, 1, 15, 54, 17)'},
+        ]})
+
+        data = json.loads(
+            self.client.get('/api/v1/chart/mean_time_weekday/11').data
+        )
+        self.assertEqual(data['rows'][0]['c'][1], {u'v': [6, 42, 3]})
+
+        data = json.loads(
+            self.client.get('/api/v1/chart/presence_daily/10').data
+        )
+        self.assertEqual(data['rows'], [
+            {u'c': [{u'v': u'Date(2013, 8, 10)'}, {u'v': 30047}]},
+            {u'c': [{u'v': u'Date(2013, 8, 11)'}, {u'v': 24465}]},
+            {u'c': [{u'v': u'Date(2013, 8, 12)'}, {u'v': 23705}]},
+        ])
+
+        data = json.loads(
+            self.client.get('/api/v1/chart/presence_weekday/12').data
+        )
+        self.assertEqual(data['rows'], [])
+
+        resp = self.client.get('/api/v1/chart/not_existing/10')
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get('/api/v1/chart/presence_daily/10?points=2')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bootstrap(self):
+        """
+        Test dashboard bootstrap inlined in page and served by api.
+        """
+        users = {
+            'server': u'https://intranet.stxnext.pl:443',
+            'users': [
+                {u'id': 141, u'name': u'Adam P.', u'avatar': u'/141'},
+                {u'id': 10, u'name': u'Anna K.', u'avatar': u'/10'},
+            ],
+        }
+        utils.CACHE['get_user_data'] = users
+        utils.TIMESTAMPS['get_user_data'] = float('inf')
+        try:
+            resp = self.client.get('/api/v1/bootstrap/presence_weekday')
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data)
+            self.assertEqual(data['users'], users)
+            self.assertEqual(data['user_id'], 10)
+            self.assertEqual(
+                data['chart'],
+                json.loads(
+                    self.client.get('/api/v1/chart/presence_weekday/10').data
+                ),
+            )
+
+            resp = self.client.get('/presence_weekday')
+            self.assertIn(
+                'var bootstrap = %s;' % utils.inline_json(
+                    views.dashboard_bootstrap('presence_weekday')
+                ),
+                resp.data,
+            )
+            resp = self.client.get('/api/v1/bootstrap/site_base')
+            self.assertEqual(resp.status_code, 404)
+        finally:
+            utils.CACHE.clear()
+            utils.TIMESTAMPS.clear()
+
+        main.app.config['USER_DATA_XML'] = '/not/existing.xml'
+        try:
+            resp = self.client.get('/mean_time_weekday')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('var bootstrap = null;', resp.data)
+        finally:
+            main.app.config['USER_DATA_XML'] = TEST_USERS_DATA
+            utils.CACHE.clear()
+            utils.TIMESTAMPS.clear()
+
+    def test_assets(self):
+        """
+        Test building and serving fingerprinted static assets.
+        """
+        static_folder = main.app.static_folder
+        temp_dir = tempfile.mkdtemp()
+        main.app.static_folder = os.path.join(temp_dir, 'static')
+        shutil.copytree(static_folder, main.app.static_folder)
+        try:
+            resp = self.client.get('/')
+            self.assertIn('/static/css/style.css', resp.data)
+
+            manifest = assets.build()
+            self.assertItemsEqual(manifest, assets.ASSETS)
+            built = manifest['css/style.css']
+            self.assertRegexpMatches(built, r'^css/style\.[0-9a-f]{12}\.css$')
+            self.assertTrue(os.path.isfile(assets.dist_path(built + '.gz')))
+            self.assertFalse(os.path.isfile(
+                assets.dist_path(manifest['img/loading.gif'] + '.gz')
+            ))
+            self.assertEqual(assets.build(), manifest)
+
+            resp = self.client.get('/')
+            self.assertIn('/assets/' + built, resp.data)
+            self.assertNotIn('/static/css/style.css', resp.data)
+
+            with open(os.path.join(static_folder, 'css', 'style.css')) as css:
+                content = css.read()
+            resp = self.client.get('/assets/' + built)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/css')
+            self.assertEqual(
+                resp.headers['Cache-Control'], assets.ASSET_CACHE_CONTROL
+            )
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(resp.data, content)
+
+            resp = self.client.get(
+                '/assets/' + built, headers={'Accept-Encoding': 'gzip'}
+            )
+            self.assertEqual(resp.mimetype, 'text/css')
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            self.assertEqual(
+                zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), content
+            )
+
+            resp = self.client.get('/assets/css/not_existing.css')
+            self.assertEqual(resp.status_code, 404)
+        finally:
+            main.app.static_folder = static_folder
+            shutil.rmtree(temp_dir)
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -181,6 +443,48 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         """
         pass
 
+    def test_memorize_refresh(self):
+        """
+        Test refreshing of memorized data before expiry.
+        """
+        calls = []
+
+        @utils.memorize('test_refresh', 30)
+        def _counter():
+            calls.append(1)
+            return len(calls)
+
+        try:
+            self.assertEqual(_counter(), 1)
+            self.assertEqual(_counter(), 1)
+            self.assertEqual(_counter.refresh(), 2)
+            self.assertEqual(_counter(), 2)
+        finally:
+            utils.CACHE.pop('test_refresh', None)
+            utils.TIMESTAMPS.pop('test_refresh', None)
+
+    def test_pin_cache(self):
+        """
+        Test pinning memorized data shared with forked workers.
+        """
+        utils.get_data()
+        utils.pin_cache('get_data')
+        self.assertEqual(utils.TIMESTAMPS['get_data'], float('inf'))
+        utils.pin_cache('not_memorized')
+        self.assertNotIn('not_memorized', utils.TIMESTAMPS)
+        utils.get_data.refresh()
+        self.assertNotEqual(utils.TIMESTAMPS['get_data'], float('inf'))
+
+    def test_percentile(self):
+        """
+        Test percentile used by load test report.
+        """
+        values = range(1, 101)
+        self.assertEqual(loadtest.percentile(values, 50), 51)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertEqual(loadtest.percentile(values, 100), 100)
+        self.assertEqual(loadtest.percentile([], 50), 0)
+
     def test_get_user_data(self):
         """
         Test parsing of user XML file.
@@ -219,6 +523,273 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(data[10][sample_date]['start'],
                          datetime.time(9, 39, 5))
 
+    def test_index_csv(self):
+        """
+        Test lazy indexing of CSV file.
+        """
+        data = utils.get_data()
+        lazy_data = utils.LazyPresenceData(
+            utils.merge_offsets(
+                [TEST_DATA_CSV], [utils.index_csv(TEST_DATA_CSV)[0]]
+            ),
+            1,
+        )
+        self.assertItemsEqual(lazy_data.keys(), [10, 11])
+        self.assertIn(10, lazy_data)
+        self.assertNotIn(12, lazy_data)
+        self.assertEqual(len(lazy_data.cache), 0)
+        self.assertDictEqual(lazy_data[10], data[10])
+        self.assertDictEqual(lazy_data[11], data[11])
+        self.assertEqual(len(lazy_data.cache), 1)
+        self.assertIsNone(lazy_data.get(12))
+
+    def test_lru_cache(self):
+        """
+        Test eviction of least recently used items.
+        """
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_get_data_directory(self):
+        """
+        Test merging of CSV files from data directory.
+        """
+        data_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(data_dir, '2013-09.csv'), 'w') as csvfile:
+                csvfile.write('10,2013-09-10,09:00:00,17:00:00\n')
+            with open(os.path.join(data_dir, '2013-10.csv'), 'w') as csvfile:
+                csvfile.write('10,2013-10-01,08:00:00,16:00:00\n'
+                              '12,2013-10-01,10:00:00,12:00:00\n')
+            main.app.config.update({'DATA_CSV': data_dir})
+            utils.CACHE.clear()
+            utils.TIMESTAMPS.clear()
+            data = utils.get_data()
+            self.assertItemsEqual(data.keys(), [10, 12])
+            self.assertItemsEqual(data[10].keys(), [
+                datetime.date(2013, 9, 10),
+                datetime.date(2013, 10, 1),
+            ])
+            utils.TIMESTAMPS.clear()
+            self.assertIs(utils.get_data(), data)
+        finally:
+            shutil.rmtree(data_dir)
+            utils.CACHE.clear()
+            utils.TIMESTAMPS.clear()
+
+    def test_rollups(self):
+        """
+        Test weekly and monthly rollups merged from many files.
+        """
+        data_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(data_dir, '2013-09.csv'), 'w') as csvfile:
+                csvfile.write('10,2013-09-29,09:00:00,17:00:00\n'
+                              '10,2013-09-30,09:00:00,17:00:00\n')
+            with open(os.path.join(data_dir, '2013-10.csv'), 'w') as csvfile:
+                csvfile.write('10,2013-09-30,10:00:00,12:00:00\n'
+                              '10,2013-10-01,08:00:00,16:00:00\n')
+            main.app.config.update({'DATA_CSV': data_dir})
+            utils.CACHE.clear()
+            utils.TIMESTAMPS.clear()
+            rollups = utils.get_rollups()
+            self.assertDictEqual(rollups, {10: {
+                'week': {
+                    '2013-W39': [8 * 3600, 1],
+                    '2013-W40': [10 * 3600, 2],
+                },
+                'month': {
+                    '2013-09': [10 * 3600, 2],
+                    '2013-10': [8 * 3600, 1],
+                },
+            }})
+            self.assertDictEqual(
+                rollups, utils.build_rollups(utils.get_data())
+            )
+            self.assertIn(
+                ('build_rollups', os.path.join(data_dir, '2013-10.csv')),
+                utils.FILE_CACHE,
+            )
+            self.assertEqual(
+                utils.date_ranges(utils.get_data()),
+                {10: (datetime.date(2013, 9, 29), datetime.date(2013, 10, 1))},
+            )
+
+            main.app.config['DATA_LAZY'] = True
+            utils.TIMESTAMPS.clear()
+            self.assertIsNone(utils.get_rollups())
+        finally:
+            main.app.config.pop('DATA_LAZY', None)
+            shutil.rmtree(data_dir)
+            utils.CACHE.clear()
+            utils.TIMESTAMPS.clear()
+
+    def test_load_workers(self):
+        """
+        Test parsing in processes only where forking is safe.
+        """
+        main.app.config['DATA_LOAD_WORKERS'] = 4
+        try:
+            self.assertEqual(utils.load_workers(), 1)
+            utils.PARALLEL_LOAD['enabled'] = True
+            self.assertEqual(utils.load_workers(), 4)
+        finally:
+            utils.PARALLEL_LOAD['enabled'] = False
+            main.app.config.pop('DATA_LOAD_WORKERS')
+
+    def test_prune_file_cache(self):
+        """
+        Test dropping cached results of removed data files.
+        """
+        data_dir = tempfile.mkdtemp()
+        try:
+            for name in ('2013-09.csv', '2013-10.csv'):
+                with open(os.path.join(data_dir, name), 'w') as csvfile:
+                    csvfile.write('10,2013-09-30,09:00:00,17:00:00\n')
+            main.app.config.update({'DATA_CSV': data_dir})
+            utils.CACHE.clear()
+            utils.TIMESTAMPS.clear()
+            utils.get_data()
+            removed = os.path.join(data_dir, '2013-09.csv')
+            self.assertIn(('parse_csv', removed), utils.FILE_CACHE)
+            self.assertIn(('build_rollups', removed), utils.FILE_CACHE)
+
+            os.remove(removed)
+            utils.TIMESTAMPS.clear()
+            utils.get_data()
+            self.assertNotIn(('parse_csv', removed), utils.FILE_CACHE)
+            self.assertNotIn(('build_rollups', removed), utils.FILE_CACHE)
+            self.assertIn(
+                ('parse_csv', os.path.join(data_dir, '2013-10.csv')),
+                utils.FILE_CACHE,
+            )
+        finally:
+            shutil.rmtree(data_dir)
+            utils.CACHE.clear()
+            utils.TIMESTAMPS.clear()
+
+    def test_lazy_stale_index(self):
+        """
+        Test skipping rows of other users after data file is rewritten.
+        """
+        csvfile = tempfile.NamedTemporaryFile(suffix='.csv')
+        csvfile.write('10,2013-09-10,09:00:00,17:00:00\n'
+                      '11,2013-09-10,10:00:00,18:00:00\n')
+        csvfile.flush()
+        lazy_data = utils.LazyPresenceData(
+            utils.merge_offsets(
+                [csvfile.name], [utils.index_csv(csvfile.name)[0]]
+            ),
+            1,
+        )
+        csvfile.seek(0)
+        csvfile.write('11,2013-09-10,10:00:00,18:00:00\n'
+                      '10,2013-09-10,09:00:00,17:00:00\n')
+        csvfile.flush()
+        utils.TIMESTAMPS['get_data'] = float('inf')
+        try:
+            self.assertEqual(lazy_data[10], {})
+            self.assertNotIn('get_data', utils.TIMESTAMPS)
+        finally:
+            utils.TIMESTAMPS.clear()
+
+    def test_get_data_compressed(self):
+        """
+        Test reading of compressed CSV files.
+        """
+        data = utils.get_data()
+        data_dir = tempfile.mkdtemp()
+        try:
+            with open(TEST_DATA_CSV, 'rb') as csvfile:
+                content = csvfile.read()
+            paths = [os.path.join(data_dir, 'data.csv.gz')]
+            gzfile = gzip.open(paths[0], 'wb')
+            gzfile.write(content)
+            gzfile.close()
+            if utils.zstandard is not None:
+                paths.append(os.path.join(data_dir, 'data.csv.zst'))
+                with open(paths[1], 'wb') as zstfile:
+                    zstfile.write(
+                        utils.zstandard.ZstdCompressor().compress(content)
+                    )
+            for path in paths:
+                self.assertDictEqual(utils.parse_csv(path)[0], data)
+                lazy_data = utils.LazyPresenceData(
+                    utils.merge_offsets([path], [utils.index_csv(path)[0]]),
+                    1,
+                )
+                self.assertDictEqual(lazy_data[11], data[11])
+        finally:
+            shutil.rmtree(data_dir)
+
+    def test_parse_csv_validation(self):
+        """
+        Test reporting of invalid and suspicious rows.
+        """
+        csvfile = tempfile.NamedTemporaryFile(suffix='.csv')
+        csvfile.write(
+            'user_id,start,end\n'
+            '10,2013-09-10,09:00:00,17:00:00\n'
+            '11,2013-09-10,09:00:00\n'
+            '11,2013-13-10,09:00:00,17:00:00\n'
+            '10,2013-09-11,17:00:00,09:00:00\n'
+            '10,2013-09-10,10:00:00,18:00:00\n'
+            '10,2013-09-12,10:00:00,10:00:00\n'
+            '10,2013-09-13,04:00:00,23:00:00\n'
+            '\n'
+        )
+        csvfile.flush()
+        data, report = utils.parse_csv(csvfile.name)
+        self.assertItemsEqual(data.keys(), [10])
+        self.assertItemsEqual(data[10].keys(), [
+            datetime.date(2013, 9, 10),
+            datetime.date(2013, 9, 12),
+            datetime.date(2013, 9, 13),
+        ])
+        self.assertEqual(data[10][datetime.date(2013, 9, 10)]['start'],
+                         datetime.time(10, 0, 0))
+        self.assertEqual(report['rows'], 8)
+        self.assertDictEqual(report['errors'], {
+            'malformed': 2,
+            'invalid': 1,
+            'end_before_start': 1,
+            'duplicate': 1,
+            'zero_duration': 1,
+            'too_long': 1,
+        })
+        self.assertEqual(report['samples']['malformed'], [1, 3])
+        self.assertEqual(report['samples']['invalid'], [4])
+
+        data, report = utils.parse_csv(csvfile.name, validate=False)
+        self.assertEqual(len(data[10]), 3)
+        self.assertEqual(report['errors']['duplicate'], 0)
+
+        offsets, report = utils.index_csv(csvfile.name)
+        self.assertEqual(len(offsets[10]), 5)
+        self.assertEqual(report['errors']['malformed'], 2)
+        lazy_data = utils.LazyPresenceData(
+            utils.merge_offsets([csvfile.name], [offsets]), 1
+        )
+        self.assertEqual(len(lazy_data[10]), 3)
+
+    def test_bench_validation(self):
+        """
+        Test benchmark of validation stage.
+        """
+        result = benchmarks.bench_validation(TEST_DATA_CSV, 1)
+        self.assertEqual(result['rows'], 9)
+        self.assertItemsEqual(
+            result.keys(), ['rows', 'parse', 'parse_validate', 'validation']
+        )
+        self.assertGreaterEqual(result['validation'], 0)
+
     def test_group_by_weekday(self):
         """
         Test weekday grouping
@@ -295,6 +866,358 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertAlmostEqual(utils.mean([30.3, 70.2, 1]), 33.8333333)
         self.assertAlmostEqual(utils.mean([0.1, 0.2, 0.3]), 0.2)
 
+    def test_downsample(self):
+        """
+        Test reducing chart series with largest triangle three buckets.
+        """
+        points = [(x, 0) for x in range(100)]
+        points[50] = (50, 100)
+        sampled = charts.downsample(points, 10)
+        self.assertEqual(len(sampled), 10)
+        self.assertEqual(sampled[0], (0, 0))
+        self.assertEqual(sampled[-1], (99, 0))
+        self.assertIn((50, 100), sampled)
+        self.assertEqual(charts.downsample(points[:5], 10), points[:5])
+        self.assertEqual(
+            charts.downsample(points, 2), charts.downsample(points, 3)
+        )
+        self.assertEqual(len(charts.downsample(points, 2)), 3)
+
+
+class PresenceAnalyzerStorageTestCase(unittest.TestCase):
+    """
+    Storage backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.data_dir = tempfile.mkdtemp()
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'USER_DATA_XML': TEST_USERS_DATA,
+            'DATABASE': os.path.join(self.data_dir, 'presence.db'),
+        })
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.data_dir)
+        main.app.config.pop('STORAGE', None)
+        storage.STORAGES.clear()
+
+    def test_init_db(self):
+        """
+        Test importing CSV data into SQLite storage.
+        """
+        storage.init_db()
+        main.app.config['STORAGE'] = 'sqlite'
+        sqlite_storage = storage.get_storage()
+        self.assertIsInstance(sqlite_storage, storage.SQLiteStorage)
+        self.assertDictEqual(sqlite_storage.load(), utils.get_data())
+
+    def test_sqlite_warm_up(self):
+        """
+        Test warming up and refreshing SQLite storage without CSV parsing.
+        """
+        storage.init_db()
+        main.app.config['STORAGE'] = 'sqlite'
+        utils.CACHE.clear()
+        utils.TIMESTAMPS.clear()
+        try:
+            warmup.warm_up()
+            storage.refresh_storage()
+            self.assertEqual(
+                storage.get_storage().signature(), storage.storage_version()
+            )
+            self.assertNotIn('get_data', utils.CACHE)
+            self.assertTrue(warmup.READY.is_set())
+
+            sqlite_storage = storage.get_storage()
+            connection = sqlite_storage.connection
+            storage.close_storages()
+            self.assertIsNone(sqlite_storage.local.connection)
+            self.assertIsNot(sqlite_storage.connection, connection)
+            self.assertTrue(sqlite_storage.has_user(10))
+        finally:
+            warmup.READY.clear()
+
+    def test_sqlite_health(self):
+        """
+        Test health status of SQLite storage without loading CSV data.
+        """
+        main.app.config['STORAGE'] = 'sqlite'
+        client = main.app.test_client()
+        data = json.loads(client.get('/health').data)
+        self.assertEqual(data['state'], u'failed')
+        self.assertIsNotNone(data['last_reload_error'])
+
+        main.app.config.pop('STORAGE')
+        storage.init_db()
+        main.app.config['STORAGE'] = 'sqlite'
+        storage.STORAGES.clear()
+        utils.CACHE.clear()
+        utils.TIMESTAMPS.clear()
+        data = json.loads(client.get('/health').data)
+        self.assertEqual(data['state'], u'loaded')
+        self.assertEqual(
+            data['data_version'], list(storage.get_storage().version())
+        )
+        self.assertEqual(data['users'], 2)
+        self.assertEqual(data['rows'], 9)
+        self.assertNotIn('get_data', utils.CACHE)
+
+    def test_sqlite_storage(self):
+        """
+        Test SQLite storage queries against CSV storage.
+        """
+        csv_storage = storage.get_storage()
+        self.assertIsInstance(csv_storage, storage.CSVStorage)
+        sqlite_storage = storage.SQLiteStorage(main.app.config['DATABASE'])
+        sqlite_storage.create_tables()
+        sqlite_storage.import_data(csv_storage.load())
+
+        self.assertEqual(sqlite_storage.users(), [10, 11])
+        self.assertTrue(sqlite_storage.has_user(11))
+        self.assertFalse(sqlite_storage.has_user(12))
+        self.assertDictEqual(
+            sqlite_storage.user_rows(11), csv_storage.user_rows(11)
+        )
+        start, end = datetime.date(2013, 9, 10), datetime.date(2013, 9, 12)
+        self.assertItemsEqual(sqlite_storage.range(11, start, end).keys(), [
+            datetime.date(2013, 9, 10),
+            datetime.date(2013, 9, 11),
+            datetime.date(2013, 9, 12),
+        ])
+        self.assertDictEqual(
+            sqlite_storage.range(11, start, end),
+            csv_storage.range(11, start, end),
+        )
+        for weekday, intervals in csv_storage.weekday_intervals(11).items():
+            self.assertItemsEqual(
+                sqlite_storage.weekday_intervals(11)[weekday], intervals
+            )
+        for weekday, times in csv_storage.weekday_start_end(11).items():
+            sqlite_times = sqlite_storage.weekday_start_end(11)[weekday]
+            self.assertItemsEqual(sqlite_times['starts'], times['starts'])
+            self.assertItemsEqual(sqlite_times['ends'], times['ends'])
+
+        main.app.config['STORAGE'] = 'sqlite'
+        client = main.app.test_client()
+        resp = client.get('/api/v1/mean_time_weekday/11')
+        self.assertEqual(len(json.loads(resp.data)), 7)
+        resp = client.get('/api/v1/users')
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_trend(self):
+        """
+        Test weekly and monthly presence of CSV, lazy and SQLite storages.
+        """
+        csv_storage = storage.get_storage()
+        sqlite_storage = storage.SQLiteStorage(main.app.config['DATABASE'])
+        sqlite_storage.create_tables()
+        sqlite_storage.import_data(csv_storage.load())
+
+        self.assertEqual(csv_storage.trend(11, 'week'), [
+            ('2013-W36', 22999, 1),
+            ('2013-W37', 95403, 5),
+        ])
+        self.assertEqual(csv_storage.trend(11, 'month'), [
+            ('2013-09', 118402, 6),
+        ])
+        self.assertEqual(csv_storage.trend(12, 'week'), [])
+        for period in utils.ROLLUP_PERIODS:
+            self.assertEqual(
+                sqlite_storage.trend(11, period),
+                csv_storage.trend(11, period),
+            )
+
+        main.app.config['DATA_LAZY'] = True
+        utils.TIMESTAMPS.clear()
+        try:
+            self.assertEqual(csv_storage.trend(11, 'week'), [
+                ('2013-W36', 22999, 1),
+                ('2013-W37', 95403, 5),
+            ])
+        finally:
+            main.app.config.pop('DATA_LAZY', None)
+            utils.CACHE.clear()
+            utils.TIMESTAMPS.clear()
+
+
+class PresenceAnalyzerWarmupTestCase(unittest.TestCase):
+    """
+    Cache warm-up tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'USER_DATA_XML': TEST_USERS_DATA,
+        })
+        self.client = main.app.test_client()
+        warmup.READY.clear()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('WARMUP_USERS', None)
+        main.app.config.pop('ACCESS_LOG', None)
+        warmup.READY.clear()
+
+    def test_top_users(self):
+        """
+        Test counting most requested users in access log.
+        """
+        logfile = tempfile.NamedTemporaryFile()
+        logfile.write(
+            '127.0.0.1 - - [01/Oct/2013:10:00:00 +0200] '
+            '"GET /api/v1/presence_weekday/11 HTTP/1.1" 200 10\n'
+            '127.0.0.1 - - [01/Oct/2013:10:00:01 +0200] '
+            '"GET /api/v1/mean_time_weekday/11 HTTP/1.1" 200 10\n'
+            '127.0.0.1 - - [01/Oct/2013:10:00:02 +0200] '
+            '"GET /api/v1/presence_weekday/10 HTTP/1.1" 200 10\n'
+            '127.0.0.1 - - [01/Oct/2013:10:00:03 +0200] '
+            '"GET /api/v1/users HTTP/1.1" 200 10\n'
+            '127.0.0.1 - - [01/Oct/2013:10:00:04 +0200] '
+            '"GET /api/v1/chart/presence_weekday/10 HTTP/1.1" 200 10\n'
+            '127.0.0.1 - - [01/Oct/2013:10:00:05 +0200] '
+            '"GET /api/v1/chart/presence_daily/11?points=50 HTTP/1.1" 200 1\n'
+        )
+        logfile.flush()
+        self.assertEqual(warmup.top_users(logfile.name, 20), [11, 10])
+        self.assertEqual(warmup.top_users(logfile.name, 1), [11])
+        self.assertEqual(warmup.top_users('/not/existing.log', 1), [])
+        # last but one line read partially and skipped
+        logfile.seek(0)
+        tail = len(logfile.readlines()[-1]) + 10
+        self.assertEqual(warmup.top_users(logfile.name, 20, tail), [11])
+
+        main.app.config['ACCESS_LOG'] = logfile.name
+        self.assertEqual(warmup.warmup_users(), [11, 10])
+        main.app.config['WARMUP_USERS'] = [10]
+        self.assertEqual(warmup.warmup_users(), [10])
+
+    def test_warm_up(self):
+        """
+        Test readiness reported after warm-up.
+        """
+        resp = self.client.get('/ready')
+        self.assertEqual(resp.status_code, 503)
+        self.assertFalse(json.loads(resp.data)['ready'])
+
+        main.app.config['WARMUP_USERS'] = [10, 11]
+        warmup.warm_up()
+        version = storage.get_storage().version()
+        for name in charts.CHARTS:
+            self.assertIsNotNone(utils.RESULT_CACHE.get(
+                ('chart_table', version, (name, 11), ())
+            ))
+
+        resp = self.client.get('/ready')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertTrue(data['ready'])
+        self.assertEqual(data['state'], u'loaded')
+
+    def test_warm_up_disabled(self):
+        """
+        Test readiness reported after data load with warm-up disabled.
+        """
+        main.app.config.update({'WARMUP': False, 'WARMUP_USERS': [10]})
+        utils.RESULT_CACHE.items.clear()
+        try:
+            warmup.warm_up()
+            self.assertEqual(len(utils.RESULT_CACHE), 0)
+            resp = self.client.get('/ready')
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(json.loads(resp.data)['ready'])
+        finally:
+            main.app.config.pop('WARMUP', None)
+
+    def test_health(self):
+        """
+        Test health status without triggering data reload.
+        """
+        utils.CACHE.clear()
+        utils.TIMESTAMPS.clear()
+        utils.MERGED_CACHE.clear()
+        utils.LOAD_STATS.clear()
+        resp = self.client.get('/health')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['state'], u'loading')
+        self.assertFalse(data['ready'])
+        self.assertNotIn('get_data', utils.CACHE)
+
+        utils.get_data()
+        data = json.loads(self.client.get('/health').data)
+        self.assertEqual(data['state'], u'loaded')
+        self.assertEqual(data['files'], 1)
+        self.assertEqual(data['users'], 2)
+        self.assertEqual(data['rows'], 9)
+        self.assertIsNone(data['last_reload_error'])
+        self.assertGreater(data['cache']['expires_in'], 0)
+        self.assertIsNone(data['cache']['lazy_users'])
+
+        main.app.config['XML_URL'] = 'file:///not/existing.xml'
+        try:
+            self.assertRaises(IOError, utils.refresh_xml)
+        finally:
+            del main.app.config['XML_URL']
+        data = json.loads(self.client.get('/health').data)
+        self.assertIn('URLError', data['xml_error'])
+
+
+class PresenceAnalyzerPreforkTestCase(unittest.TestCase):
+    """
+    Pre-fork server master tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.server = prefork.PreforkServer(main.app, 'localhost', 0, 0, 25)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        utils.CACHE.clear()
+        utils.TIMESTAMPS.clear()
+
+    def test_reload_failure(self):
+        """
+        Test master surviving data errors and retrying reload.
+        """
+        main.app.config['DATA_CSV'] = '/not/existing.csv'
+        self.server.check()
+        self.assertFalse(self.server.reload_requested)
+
+        main.app.config['DATA_CSV'] = TEST_DATA_CSV
+        refresh_storage = storage.refresh_storage
+
+        def _failing_refresh():
+            raise IOError('data file being written')
+
+        storage.refresh_storage = _failing_refresh
+        try:
+            self.server.check()
+            self.assertTrue(self.server.reload_requested)
+            self.server.safe_reload()
+        finally:
+            storage.refresh_storage = refresh_storage
+        self.assertIsNone(self.server.signature)
+        self.assertEqual(self.server.children, set())
+
 
 def suite():
     """
@@ -303,6 +1226,9 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerStorageTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerWarmupTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerPreforkTestCase))
     return suite
 
 
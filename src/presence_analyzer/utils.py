@@ -3,35 +3,154 @@
 Helper functions used in views.
 """
 
+import io
+import os
+import re
 import csv
+import glob
+import gzip
+import zlib
+import hashlib
 import urllib2
+import multiprocessing
 import time
 import threading
 import locale
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
 from json import dumps
 from functools import wraps
 from datetime import datetime
 from lxml import etree
 from functools import wraps
-from flask import Response
+from flask import Response, request
 
 from presence_analyzer.main import app
 
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # pylint: disable-msg=C0103
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None  # pylint: disable-msg=C0103
+
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 CACHE = {}
 TIMESTAMPS = {}
+VERSIONS = {}
+
+# parsed data files keyed by (loader name, path)
+FILE_CACHE = {}
+# last merged result with signature of files it was built from
+MERGED_CACHE = {}
+
+# statistics of last presence data load and user XML refresh
+LOAD_STATS = {}
+XML_STATS = {}
 
 LOCK = threading.Lock()
 
+# size of blocks read from (compressed) data files
+DATA_READ_BLOCK = 1024 * 1024
+DATA_FILE_PATTERNS = ('*.csv', '*.csv.gz', '*.csv.zst')
+
+# kinds of rows reported while loading data, DROPPED_ERRORS are skipped
+ROW_ERRORS = (
+    'malformed',
+    'invalid',
+    'end_before_start',
+    'duplicate',
+    'zero_duration',
+    'too_long',
+)
+DROPPED_ERRORS = ('malformed', 'invalid', 'end_before_start')
+# longer presence is most likely a missing checkout
+MAX_INTERVAL = 16 * 3600
+# line numbers remembered per kind of error
+ERROR_SAMPLES = 20
+
+# periods of presence rollups, see build_rollups
+ROLLUP_PERIODS = ('week', 'month')
+ROLLUP_KEY_RES = {
+    'week': re.compile(r'^\d{4}-W(0[1-9]|[1-4]\d|5[0-3])$'),
+    'month': re.compile(r'^\d{4}-(0[1-9]|1[0-2])$'),
+}
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPES = ('application/x-msgpack', 'application/msgpack')
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping keeping at most `size` recently used items.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        """
+        Returns cached item and marks it as recently used.
+        """
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        """
+        Stores item, evicting least recently used ones above the limit.
+        """
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+# encoded API responses keyed by (body digest, mimetype, encoding)
+ENCODED_CACHE = LRUCache(256)
+# view results keyed by (function name, data version, arguments)
+RESULT_CACHE = LRUCache(1024)
+_MISSING = object()
+
+RELOADER = {}
+
+# data files are parsed in forked processes only while no other threads
+# may hold locks, i.e. in prefork master, see PreforkServer.load
+PARALLEL_LOAD = {'enabled': False}
+
 
 def memorize(key, period):
     """
     Memorizing decorator. Returning cached data
     if its validity period is not expired
+
+    Decorated function gets `refresh` attribute recomputing the data
+    without waiting for expiry. Version of data stored in VERSIONS is
+    bumped whenever function returns different object.
     """
     def _decoration_wrapper(func):
+        def _store(ret, expires):
+            if CACHE.get(key) is not ret:
+                VERSIONS[key] = VERSIONS.get(key, 0) + 1
+            CACHE[key] = ret
+            TIMESTAMPS[key] = expires
+
         @wraps(func)
         def _caching_wrapper(*args, **kwargs):
             cache_key = key
@@ -41,8 +160,37 @@ def memorize(key, period):
                 return CACHE[cache_key]
 
             ret = func(*args, **kwargs)
-            CACHE[cache_key] = ret
-            TIMESTAMPS[cache_key] = now + period
+            _store(ret, now + period)
+            return ret
+
+        def _refresh(*args, **kwargs):
+            """
+            Recomputes cached data, replacing it once ready.
+            """
+            ret = func(*args, **kwargs)
+            _store(ret, time.time() + period)
+            return ret
+
+        _caching_wrapper.refresh = _refresh
+        return _caching_wrapper
+    return _decoration_wrapper
+
+
+def memorize_per_version(version):
+    """
+    Memorizing decorator keeping results per arguments until
+    `version()` returns another value.
+    """
+    def _decoration_wrapper(func):
+        @wraps(func)
+        def _caching_wrapper(*args, **kwargs):
+            cache_key = (
+                func.__name__, version(), args, tuple(sorted(kwargs.items()))
+            )
+            ret = RESULT_CACHE.get(cache_key, _MISSING)
+            if ret is _MISSING:
+                ret = func(*args, **kwargs)
+                RESULT_CACHE.set(cache_key, ret)
             return ret
         return _caching_wrapper
     return _decoration_wrapper
@@ -60,31 +208,218 @@ def locker(func):
     return _lock_wrapper
 
 
+def pin_cache(key):
+    """
+    Makes memorized data never expire, until it is refreshed explicitly.
+    """
+    if key in CACHE:
+        TIMESTAMPS[key] = float('inf')
+
+
+def data_version():
+    """
+    Returns version of presence data, bumped when get_data() reloads it.
+    """
+    return VERSIONS.get('get_data', 0)
+
+
+def data_stats():
+    """
+    Returns load state, version, freshness and counts of CSV data.
+
+    Only in-memory state is inspected, so it never reloads data
+    nor touches data files.
+    """
+    now = time.time()
+    cached = MERGED_CACHE.get('data')
+    loaded_at = LOAD_STATS.get('loaded_at')
+    if loaded_at is None:
+        state = 'failed' if LOAD_STATS.get('error') else 'loading'
+    else:
+        state = 'loaded'
+    data_modified = None
+    if cached is not None and cached[0][1]:
+        data_modified = max(mtime for _, (mtime, _) in cached[0][1])
+
+    return {
+        'state': state,
+        'data_version': data_version(),
+        'data_age': now - loaded_at if loaded_at is not None else None,
+        'data_modified': data_modified,
+        'files': LOAD_STATS.get('files'),
+        'users': LOAD_STATS.get('users'),
+        'rows': LOAD_STATS.get('rows'),
+        'last_reload_duration': LOAD_STATS.get('duration'),
+        'last_reload_error': LOAD_STATS.get('error'),
+        'row_errors': (
+            sum(MERGED_CACHE['report']['errors'].itervalues())
+            if 'report' in MERGED_CACHE else None
+        ),
+        'last_check_age': (
+            now - LOAD_STATS['checked_at']
+            if 'checked_at' in LOAD_STATS else None
+        ),
+    }
+
+
+def health_status(stats=None):
+    """
+    Returns data stats of storage backend, data_stats() by default,
+    together with user data state and cache sizes.
+    """
+    now = time.time()
+    cached = MERGED_CACHE.get('data')
+    expires = TIMESTAMPS.get('get_data')
+    status = dict(data_stats() if stats is None else stats)
+    status.update({
+        'xml_refreshed_at': XML_STATS.get('refreshed_at'),
+        'xml_error': XML_STATS.get('error'),
+        'cache': {
+            'memorized': len(CACHE),
+            'expires_in': (
+                expires - now
+                if expires is not None and expires != float('inf') else None
+            ),
+            'files': len(FILE_CACHE),
+            'results': len(RESULT_CACHE),
+            'encoded': len(ENCODED_CACHE),
+            'lazy_users': (
+                len(cached[1].cache)
+                if cached is not None and
+                isinstance(cached[1], LazyPresenceData) else None
+            ),
+        },
+    })
+    return status
+
+
+def start_reloader(interval, on_change=None, refresh=None, version=None):
+    """
+    Starts daemon thread refreshing presence data every `interval` seconds.
+
+    Refresh does not take the global lock, so requests keep being served
+    from previous data while the new one is loaded. `on_change` is called
+    after data version changes. Only one reloader is started per process.
+
+    `refresh` and `version` default to get_data.refresh and data_version,
+    storage backends pass their own.
+    """
+    if 'thread' in RELOADER:
+        return RELOADER['thread']
+    refresh = refresh or get_data.refresh
+    version = version or data_version
+
+    def _reload():
+        while True:
+            time.sleep(interval)
+            try:
+                previous = version()
+                refresh()
+                if on_change is not None and version() != previous:
+                    on_change()
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Presence data reload failed')
+
+    thread = threading.Thread(target=_reload, name='presence-reloader')
+    thread.daemon = True
+    thread.start()
+    RELOADER['thread'] = thread
+    return thread
+
+
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    MessagePack and gzip/deflate variants are served to clients asking
+    for them in Accept and Accept-Encoding headers.
     """
     @wraps(function)
     def inner(*args, **kwargs):
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        return encode_response(function(*args, **kwargs))
     return inner
 
 
+def inline_json(value):
+    """
+    Returns JSON representation of value safe to embed in <script> tag.
+    """
+    return dumps(value).replace('</', '<\\/')
+
+
+def encode_response(result):
+    """
+    Creates a response with representation of result negotiated with client.
+
+    Bodies shorter than RESPONSE_COMPRESS_MIN_SIZE are never compressed.
+    Encoded variants are cached by digest of JSON body.
+    """
+    body = dumps(result)
+    mimetype = JSON_MIMETYPE
+    if msgpack is not None:
+        mimetype = request.accept_mimetypes.best_match(
+            (JSON_MIMETYPE,) + MSGPACK_MIMETYPES,
+            default=JSON_MIMETYPE,
+        )
+    encoding = None
+    if len(body) >= app.config.get('RESPONSE_COMPRESS_MIN_SIZE', 1024):
+        encoding = request.accept_encodings.best_match(('gzip', 'deflate'))
+
+    if mimetype == JSON_MIMETYPE and encoding is None:
+        payload = body
+    else:
+        key = (hashlib.sha1(body).digest(), mimetype, encoding)
+        payload = ENCODED_CACHE.get(key)
+        if payload is None:
+            payload = encode_payload(result, body, mimetype, encoding)
+            ENCODED_CACHE.set(key, payload)
+
+    response = Response(payload, mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    return response
+
+
+def encode_payload(result, body, mimetype, encoding):
+    """
+    Serializes and compresses response payload.
+    """
+    if mimetype in MSGPACK_MIMETYPES:
+        payload = msgpack.packb(result, use_bin_type=False)
+    else:
+        payload = body
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        payload = compressor.compress(payload) + compressor.flush()
+    elif encoding == 'deflate':
+        payload = zlib.compress(payload, 6)
+    return payload
+
+
 def refresh_xml():
     """
     Download user XML data file from sargo server and save it as
     current config file.
     """
-    req = urllib2.urlopen(app.config['XML_URL'])
-    with open(app.config['USER_DATA_XML'], 'wb') as xmlfile:
-        while True:
-            chunk = req.read(16 * 1024)
-            if not chunk:
-                break
-            xmlfile.write(chunk)
+    XML_STATS['started_at'] = time.time()
+    try:
+        req = urllib2.urlopen(app.config['XML_URL'])
+        with open(app.config['USER_DATA_XML'], 'wb') as xmlfile:
+            while True:
+                chunk = req.read(16 * 1024)
+                if not chunk:
+                    break
+                xmlfile.write(chunk)
+    except Exception as error:
+        XML_STATS['error'] = repr(error)
+        raise
+    XML_STATS['refreshed_at'] = time.time()
+    XML_STATS['error'] = None
 
 
+@locker
+@memorize('get_user_data', 30)
 def get_user_data():
     """
     Extracts user data from file specified in config.
@@ -137,26 +472,568 @@ def get_data():
             },
         }
     }
+
+    With DATA_LAZY enabled a LazyPresenceData mapping of the same shape is
+    returned instead and users are decoded on first access.
+
+    DATA_CSV may also point at a directory or glob of CSV files. Each file
+    is parsed separately and cached until its mtime or size changes.
+    Files ending with .gz or .zst are decompressed while being read.
+    """
+    started = time.time()
+    LOAD_STATS['checked_at'] = started
+    previous = MERGED_CACHE.get('data', (None, None))[1]
+    try:
+        data = load_data()
+    except Exception as error:
+        LOAD_STATS['error'] = repr(error)
+        raise
+
+    if data is not previous:
+        LOAD_STATS.update({
+            'loaded_at': time.time(),
+            'duration': time.time() - started,
+            'files': len(MERGED_CACHE['data'][0][1]),
+            'users': len(data),
+            'rows': count_rows(data),
+            'error': None,
+        })
+    return data
+
+
+def load_workers():
+    """
+    Returns number of processes parsing data files.
+
+    DATA_LOAD_WORKERS is honoured only with PARALLEL_LOAD enabled,
+    elsewhere forking could deadlock children on inherited locks.
+    """
+    workers = app.config.get('DATA_LOAD_WORKERS', 1)
+    if workers > 1 and not PARALLEL_LOAD['enabled']:
+        log.warning(
+            'DATA_LOAD_WORKERS=%d ignored, parallel loading is only '
+            'supported by prefork server', workers,
+        )
+        return 1
+    return workers
+
+
+def load_data():
+    """
+    Loads presence data from configured files, reusing last merged result
+    if none of them changed.
+    """
+    lazy = bool(app.config.get('DATA_LAZY'))
+    signature = (lazy, data_signature())
+    paths = [path for path, _ in signature[1]]
+    cached = MERGED_CACHE.get('data')
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    workers = load_workers()
+    if lazy:
+        loaded = load_files(index_csv, signature[1], workers)
+        data = LazyPresenceData(
+            merge_offsets(paths, [offsets for offsets, _ in loaded]),
+            app.config.get('DATA_LAZY_CACHE_SIZE', 128),
+        )
+        rollups = None
+    else:
+        loaded = load_files(parse_csv, signature[1], workers)
+        parsed = [file_data for file_data, _ in loaded]
+        data = merge_data(parsed)
+        rollups = merge_rollups(parsed, file_rollups(signature[1], parsed))
+
+    prune_file_cache(paths)
+    MERGED_CACHE['report'] = merge_reports(
+        paths, [report for _, report in loaded]
+    )
+    MERGED_CACHE['rollups'] = rollups
+    MERGED_CACHE['data'] = (signature, data)
+    return data
+
+
+def count_rows(data):
+    """
+    Counts presence entries without decoding lazily loaded users.
+    """
+    if isinstance(data, LazyPresenceData):
+        return sum(
+            len(offsets)
+            for entries in data.offsets.itervalues()
+            for _, offsets in entries
+        )
+    return sum(len(items) for items in data.itervalues())
+
+
+def data_files(source):
+    """
+    Returns sorted list of CSV files for data source from config.
+
+    Source can be a single file, a directory or a glob pattern.
+    """
+    if os.path.isdir(source):
+        return sorted(
+            path
+            for pattern in DATA_FILE_PATTERNS
+            for path in glob.glob(os.path.join(source, pattern))
+        )
+    if glob.has_magic(source):
+        return sorted(glob.glob(source))
+    return [source]
+
+
+def data_signature():
+    """
+    Returns (path, (mtime, size)) pairs of all configured data files.
+    """
+    return tuple(
+        (path, file_signature(path))
+        for path in data_files(app.config['DATA_CSV'])
+    )
+
+
+def file_signature(path):
+    """
+    Returns (mtime, size) pair used to detect changed data files.
+    """
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def prune_file_cache(paths):
+    """
+    Drops cached results of files no longer configured as data source.
     """
+    paths = set(paths)
+    for key in FILE_CACHE.keys():
+        if key[1] not in paths:
+            del FILE_CACHE[key]
+
+
+def load_files(loader, signatures, workers=1):
+    """
+    Applies loader to every file, reusing results of unchanged files.
+
+    Changed files are loaded in a process pool if more than one worker
+    is configured.
+    """
+    results = {}
+    stale = []
+    for path, signature in signatures:
+        cached = FILE_CACHE.get((loader.__name__, path))
+        if cached is not None and cached[0] == signature:
+            results[path] = cached[1]
+        else:
+            stale.append((path, signature))
+
+    stale_paths = [path for path, _ in stale]
+    if workers > 1 and len(stale) > 1:
+        pool = multiprocessing.Pool(min(workers, len(stale)))
+        try:
+            loaded = pool.map(loader, stale_paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        loaded = [loader(path) for path in stale_paths]
+
+    for (path, signature), result in zip(stale, loaded):
+        FILE_CACHE[(loader.__name__, path)] = (signature, result)
+        results[path] = result
+
+    return [results[path] for path, _ in signatures]
+
+
+def merge_data(parsed):
+    """
+    Merges presence data of many files, later files take precedence.
+    """
+    if len(parsed) == 1:
+        return parsed[0]
+
     data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
+    for file_data in parsed:
+        for user_id, items in file_data.iteritems():
+            data.setdefault(user_id, {}).update(items)
+    return data
+
+
+def merge_reports(paths, reports):
+    """
+    Sums validation reports of many files.
+
+    Samples are (file name, line number) pairs.
+    """
+    merged = new_report()
+    for path, report in zip(paths, reports):
+        merged['rows'] += report['rows']
+        for kind in ROW_ERRORS:
+            merged['errors'][kind] += report['errors'][kind]
+            samples = merged['samples'][kind]
+            for line in report['samples'][kind]:
+                if len(samples) >= ERROR_SAMPLES:
+                    break
+                samples.append((os.path.basename(path), line))
+    return merged
+
+
+def get_validation_report():
+    """
+    Returns validation report of currently loaded presence data.
+    """
+    get_data()
+    return MERGED_CACHE['report']
+
+
+def get_rollups():
+    """
+    Returns weekly and monthly rollups of currently loaded presence data,
+    None if data is loaded lazily.
+    """
+    get_data()
+    return MERGED_CACHE['rollups']
+
+
+def file_rollups(signatures, parsed):
+    """
+    Returns (rollups, date ranges) of every parsed file, reusing ones
+    of unchanged files.
+    """
+    rollups = []
+    for (path, signature), file_data in zip(signatures, parsed):
+        cached = FILE_CACHE.get(('build_rollups', path))
+        if cached is None or cached[0] != signature:
+            cached = (
+                signature, (build_rollups(file_data), date_ranges(file_data))
+            )
+            FILE_CACHE[('build_rollups', path)] = cached
+        rollups.append(cached[1])
+    return rollups
+
+
+def date_ranges(data):
+    """
+    Returns first and last date of every user.
+    """
+    return {
+        user_id: (min(items), max(items))
+        for user_id, items in data.iteritems()
+        if items
+    }
+
+
+def merge_rollups(parsed, rollups):
+    """
+    Sums rollups of many files, given as returned by file_rollups.
+
+    Entries of a date present in several files come from the last one,
+    like in merge_data, so contribution of earlier ones is subtracted.
+    Dates are compared only for users whose date ranges overlap.
+    """
+    if len(rollups) == 1:
+        return rollups[0][0]
+
+    merged = {}
+    for file_rollup, _ in rollups:
+        for user_id, user_rollups in file_rollup.iteritems():
+            merged_user = merged.setdefault(user_id, new_rollup())
+            for period in ROLLUP_PERIODS:
+                buckets = merged_user[period]
+                for key, (seconds, days) in user_rollups[period].iteritems():
+                    bucket = buckets.setdefault(key, [0, 0])
+                    bucket[0] += seconds
+                    bucket[1] += days
+
+    for index, (_, ranges) in enumerate(rollups):
+        for user_id, (first, last) in ranges.iteritems():
+            later = [
+                parsed[later_index][user_id]
+                for later_index in xrange(index + 1, len(rollups))
+                if user_id in rollups[later_index][1] and
+                rollups[later_index][1][user_id][0] <= last and
+                rollups[later_index][1][user_id][1] >= first
+            ]
+            if not later:
+                continue
+            for date, item in parsed[index][user_id].iteritems():
+                if any(date in items for items in later):
+                    add_to_rollup(
+                        merged[user_id], date,
+                        -interval(item['start'], item['end']), -1,
+                    )
+    return merged
+
+
+def merge_offsets(paths, indexes):
+    """
+    Merges row offsets of many files into {user_id: [(path, offsets)]}.
+    """
+    offsets = {}
+    for path, index in zip(paths, indexes):
+        for user_id, user_offsets in index.iteritems():
+            offsets.setdefault(user_id, []).append((path, user_offsets))
+    return offsets
+
+
+def is_compressed(path):
+    """
+    Checks if data file has to be decompressed while reading.
+    """
+    return path.endswith(('.gz', '.zst'))
+
+
+@contextmanager
+def open_data_file(path):
+    """
+    Opens data file for reading in large blocks.
+
+    Gzip and zstd files are decompressed as a stream, without
+    inflating them to disk.
+    """
+    with open(path, 'rb', DATA_READ_BLOCK) as datafile:
+        if path.endswith('.gz'):
+            stream = gzip.GzipFile(fileobj=datafile, mode='rb')
+        elif path.endswith('.zst'):
+            if zstandard is None:
+                raise IOError('zstandard is required to read %s' % path)
+            stream = zstandard.ZstdDecompressor().stream_reader(
+                datafile, read_size=DATA_READ_BLOCK
+            )
+        else:
+            yield datafile
+            return
+        with stream:
+            yield io.BufferedReader(stream, DATA_READ_BLOCK)
+
+
+def read_lines(datafile, offsets, seek=True):
+    """
+    Yields (offset, line) pairs of lines starting at sorted offsets.
+
+    Files which cannot seek (compressed streams) are scanned forward.
+    """
+    if seek:
+        for offset in offsets:
+            datafile.seek(offset)
+            yield offset, datafile.readline()
+        return
+
+    wanted = iter(offsets)
+    target = next(wanted, None)
+    position = 0
+    for line in iter(datafile.readline, ''):
+        if target is None:
+            return
+        if position == target:
+            yield position, line
+            target = next(wanted, None)
+        position += len(line)
+
+
+def parse_row(row):
+    """
+    Converts single CSV row into (user_id, date, start, end) tuple.
+    """
+    user_id = int(row[0])
+    date = datetime.strptime(row[1], '%Y-%m-%d').date()
+    start = datetime.strptime(row[2], '%H:%M:%S').time()
+    end = datetime.strptime(row[3], '%H:%M:%S').time()
+    return user_id, date, start, end
+
+
+def new_report():
+    """
+    Returns empty validation report of data file.
+    """
+    return {
+        'rows': 0,
+        'errors': dict.fromkeys(ROW_ERRORS, 0),
+        'samples': {kind: [] for kind in ROW_ERRORS},
+    }
+
+
+def report_error(report, kind, line):
+    """
+    Counts invalid row, remembering its line number if samples are not full.
+    """
+    report['errors'][kind] += 1
+    if len(report['samples'][kind]) < ERROR_SAMPLES:
+        report['samples'][kind].append(line)
+
+
+def check_interval(start, end):
+    """
+    Returns kind of presence interval anomaly or None for valid ones.
+    """
+    seconds = interval(start, end)
+    if seconds < 0:
+        return 'end_before_start'
+    if seconds == 0:
+        return 'zero_duration'
+    if seconds > MAX_INTERVAL:
+        return 'too_long'
+    return None
+
+
+def validate_row(report, items, line, date, start, end):
+    """
+    Reports anomalies of parsed row against already loaded user items.
+
+    Returns False if row has to be skipped.
+    """
+    if date in items:
+        report_error(report, 'duplicate', line)
+    anomaly = check_interval(start, end)
+    if anomaly is not None:
+        report_error(report, anomaly, line)
+        return anomaly not in DROPPED_ERRORS
+    return True
+
+
+def parse_csv(path, validate=True):
+    """
+    Parses whole presence CSV file into dict grouped by user_id.
+
+    Returns (data, report) pair. Malformed, unparsable and end-before-start
+    rows are skipped. With `validate` duplicates and suspicious durations
+    are reported as well, such rows are kept (last duplicate wins).
+    """
+    data = {}
+    report = new_report()
+    with open_data_file(path) as csvfile:
         presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
+        for i, row in enumerate(presence_reader, 1):
+            if not row:
+                continue
+            report['rows'] += 1
             if len(row) != 4:
-                # ignore header and footer lines
+                # header, footer or broken line
+                report_error(report, 'malformed', i)
                 continue
 
             try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
+                user_id, date, start, end = parse_row(row)
             except (ValueError, TypeError):
                 log.debug('Problem with line %d: ', i, exc_info=True)
+                report_error(report, 'invalid', i)
+                continue
+
+            if validate:
+                items = data.get(user_id, ())
+                if not validate_row(report, items, i, date, start, end):
+                    continue
+            elif start > end:
+                continue
 
             data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
 
-    return data
+    return data, report
+
+
+def index_csv(path):
+    """
+    Scans presence CSV file and records byte offsets of every user's rows.
+
+    Only user_id column is decoded here, remaining columns are parsed
+    by LazyPresenceData when user is accessed. Returns dict of
+    user_id to array of offsets and validation report, which covers
+    malformed rows only.
+    """
+    offsets = {}
+    report = new_report()
+    position = 0
+    with open_data_file(path) as csvfile:
+        for i, line in enumerate(iter(csvfile.readline, ''), 1):
+            offset = position
+            position += len(line)
+            if not line.strip():
+                continue
+            report['rows'] += 1
+            if line.count(',') != 3:
+                # header, footer or broken line
+                report_error(report, 'malformed', i)
+                continue
+            try:
+                user_id = int(line[:line.index(',')])
+            except ValueError:
+                log.debug('Problem with line %d: ', i, exc_info=True)
+                report_error(report, 'invalid', i)
+                continue
+            offsets.setdefault(user_id, array('L')).append(offset)
+
+    return offsets, report
+
+
+class LazyPresenceData(object):
+    """
+    Read-only mapping of user_id to presence entries decoded on demand.
+
+    Decoded users are kept in bounded LRU cache, so only the most recently
+    requested ones stay in memory.
+    """
+
+    def __init__(self, offsets, cache_size):
+        self.offsets = offsets
+        self.cache = LRUCache(cache_size)
+
+    def __contains__(self, user_id):
+        return user_id in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def keys(self):
+        """
+        Returns list of indexed user ids.
+        """
+        return self.offsets.keys()
+
+    def get(self, user_id, default=None):
+        """
+        Returns user entries or default when user is not indexed.
+        """
+        if user_id not in self.offsets:
+            return default
+        return self[user_id]
+
+    def __getitem__(self, user_id):
+        items = self.cache.get(user_id)
+        if items is None:
+            items = self.decode(user_id)
+            self.cache.set(user_id, items)
+        return items
+
+    def decode(self, user_id):
+        """
+        Reads and parses rows of given user from CSV files.
+
+        Rows of other users mean the file was rewritten after indexing.
+        They are skipped and presence data is reloaded on next access.
+        """
+        items = {}
+        for path, offsets in self.offsets[user_id]:
+            with open_data_file(path) as csvfile:
+                lines = read_lines(csvfile, offsets, not is_compressed(path))
+                for offset, line in lines:
+                    row = next(csv.reader([line]))
+                    try:
+                        row_user_id, date, start, end = parse_row(row)
+                    except (ValueError, TypeError):
+                        log.debug('Problem with line at %d: ', offset,
+                                  exc_info=True)
+                        continue
+                    if row_user_id != user_id:
+                        log.warning('Stale index of %s at %d', path, offset)
+                        TIMESTAMPS.pop('get_data', None)
+                        continue
+                    if check_interval(start, end) in DROPPED_ERRORS:
+                        continue
+                    items[date] = {'start': start, 'end': end}
+        return items
 
 
 def group_by_weekday(items):
@@ -186,6 +1063,67 @@ def group_by_weekday_start_end(items):
     return result
 
 
+def rollup_key(period, date):
+    """
+    Returns key of bucket containing date, ISO week like 2013-W37
+    or month like 2013-09. Keys of the same period sort chronologically.
+    """
+    if period == 'week':
+        year, week, _ = date.isocalendar()
+        return '%04d-W%02d' % (year, week)
+    return '%04d-%02d' % (date.year, date.month)
+
+
+def is_rollup_key(period, key):
+    """
+    Checks if key has format of bucket keys of given period.
+    """
+    return ROLLUP_KEY_RES[period].match(key) is not None
+
+
+def new_rollup():
+    """
+    Returns empty rollup of single user.
+    """
+    return {period: {} for period in ROLLUP_PERIODS}
+
+
+def add_to_rollup(rollup, date, seconds, days=1):
+    """
+    Adds presence of date to buckets of user rollup.
+
+    Negative values remove it, emptied buckets are dropped.
+    """
+    for period in ROLLUP_PERIODS:
+        buckets = rollup[period]
+        key = rollup_key(period, date)
+        bucket = buckets.setdefault(key, [0, 0])
+        bucket[0] += seconds
+        bucket[1] += days
+        if not bucket[1]:
+            del buckets[key]
+
+
+def build_rollups(data):
+    """
+    Sums presence of every user per ISO week and per month.
+
+    It creates structure like this:
+    rollups = {
+        'user_id': {
+            'week': {'2013-W40': [seconds, days]},
+            'month': {'2013-10': [seconds, days]},
+        }
+    }
+    """
+    rollups = {}
+    for user_id, items in data.iteritems():
+        rollup = rollups[user_id] = new_rollup()
+        for date, item in items.iteritems():
+            add_to_rollup(rollup, date, interval(item['start'], item['end']))
+    return rollups
+
+
 def seconds_since_midnight(time):
     """
     Calculates amount of seconds since midnight.
@@ -3,13 +3,20 @@
 Defines views.
 """
 
+import os
+import glob
 import calendar
-from flask import redirect, url_for, make_response
-from flask.ext.mako import MakoTemplates, render_template
-from mako.exceptions import TopLevelLookupException
+from flask import redirect, url_for, make_response, request, abort
+from flask_mako import MakoTemplates, render_template
+from mako.lookup import TemplateLookup
 from presence_analyzer.main import app
-from presence_analyzer.utils import jsonify, get_data, mean, \
-    group_by_weekday, group_by_weekday_start_end, get_user_data
+from presence_analyzer.utils import jsonify, mean, get_user_data, \
+    memorize_per_version, encode_response, health_status, \
+    get_validation_report, inline_json, is_rollup_key, ROLLUP_PERIODS
+from presence_analyzer.storage import get_storage, storage_version
+from presence_analyzer.charts import CHARTS, MIN_POINTS, chart_table
+from presence_analyzer.warmup import READY
+from presence_analyzer.assets import asset_url, send_asset
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
@@ -17,6 +24,73 @@ log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 MAKO = MakoTemplates(app)
 
 
+def template_names():
+    """
+    Returns names of page templates, without extension.
+    """
+    pattern = os.path.join(app.root_path, app.template_folder, '*.html')
+    return frozenset(
+        os.path.splitext(os.path.basename(path))[0]
+        for path in glob.glob(pattern)
+    )
+
+
+# pages served by templateview, other names get 404 without lookup
+TEMPLATES = template_names()
+
+
+def template_imports():
+    """
+    Returns imports of compiled templates, the same Flask-Mako adds,
+    so modules compiled by precompile_templates are reused by it.
+    """
+    imports = list(app.config['MAKO_IMPORTS'] or [])
+    imports.append('from flask.helpers import url_for, get_flashed_messages')
+    if 'babel' in app.extensions:
+        imports.append(
+            'from flask.ext.babel import gettext as _, ngettext, '
+            'pgettext, npgettext'
+        )
+    return imports
+
+
+def precompile_templates():
+    """
+    Compiles all page templates into MAKO_MODULE_DIRECTORY, so first
+    requests of workers do not wait for it.
+
+    Templates are compiled by separate lookup with options affecting
+    generated code taken from MAKO_* config. Lookup of Flask-Mako then
+    loads the modules from disk, as their sources are not newer.
+    """
+    module_directory = app.config['MAKO_MODULE_DIRECTORY']
+    if not module_directory:
+        log.info('MAKO_MODULE_DIRECTORY not set, templates not compiled')
+        return
+    lookup = TemplateLookup(
+        directories=[os.path.join(app.root_path, app.template_folder)],
+        module_directory=module_directory,
+        input_encoding=app.config['MAKO_INPUT_ENCODING'],
+        imports=template_imports(),
+        default_filters=app.config['MAKO_DEFAULT_FILTERS'],
+        preprocessor=app.config['MAKO_PREPROCESSOR'],
+        strict_undefined=app.config['MAKO_STRICT_UNDEFINED'],
+    )
+    # module level blocks of templates build urls
+    with app.test_request_context():
+        for name in sorted(TEMPLATES):
+            lookup.get_template(name + '.html')
+    log.info('Compiled %d templates', len(TEMPLATES))
+
+
+@app.context_processor
+def inject_asset_url():
+    """
+    Makes asset_url available in templates.
+    """
+    return {'asset_url': asset_url}
+
+
 def mainpage():
     """
     Redirects to front page.
@@ -30,11 +104,92 @@ def templateview(template_name='site_base'):
     """
     Renders and response page by template name from url.
     """
-    try:
-        return render_template(template_name+'.html')
-    except TopLevelLookupException:
+    if template_name not in TEMPLATES:
         return make_response('This page does not exist', 404)
 
+    bootstrap = None
+    if template_name in CHARTS:
+        bootstrap = dashboard_bootstrap(template_name)
+    return render_template(
+        template_name+'.html',
+        bootstrap=inline_json(bootstrap),
+    )
+
+
+def dashboard_bootstrap(chart):
+    """
+    Returns users listing, default user and chart data of that user,
+    letting dashboard render without further requests.
+
+    None if user data cannot be loaded, dashboard falls back to api calls.
+    """
+    try:
+        users = get_user_data()
+    except Exception:  # pylint: disable-msg=W0703
+        log.exception('Loading user data failed')
+        return None
+
+    storage = get_storage()
+    user_id = None
+    for user in users['users']:
+        if storage.has_user(user['id']):
+            user_id = user['id']
+            break
+    return {
+        'users': users,
+        'user_id': user_id,
+        'chart': chart_table(chart, user_id) if user_id is not None else None,
+    }
+
+
+@app.route('/api/v1/bootstrap/<string:template_name>', methods=['GET'])
+@jsonify
+def bootstrap_view(template_name):
+    """
+    Returns data needed for first render of dashboard page.
+    """
+    if template_name not in CHARTS:
+        abort(404)
+    return dashboard_bootstrap(template_name)
+
+
+@app.route('/assets/<path:filename>', methods=['GET'])
+def asset_view(filename):
+    """
+    Serves fingerprinted static asset.
+    """
+    return send_asset(filename)
+
+
+@app.route('/health', methods=['GET'])
+@jsonify
+def health_view():
+    """
+    Load state, data freshness and cache statistics of worker.
+    """
+    status = health_status(get_storage().stats())
+    status['ready'] = READY.is_set()
+    return status
+
+
+@app.route('/ready', methods=['GET'])
+def ready_view():
+    """
+    Readiness of worker, 503 until cache warm-up is finished.
+
+    Like health_view it never triggers data reload.
+    """
+    ready = READY.is_set()
+    status = get_storage().stats()
+    response = encode_response({
+        'ready': ready,
+        'state': status['state'],
+        'data_version': status['data_version'],
+    })
+    if not ready:
+        response.status_code = 503
+    return response
+
 
 @app.route('/api/v2/users', methods=['GET'])
 @jsonify
@@ -51,24 +206,33 @@ def users_view():
     """
     Users listing for dropdown.
     """
-    data = get_data()
     return [{'user_id': i, 'name': 'User {0}'.format(str(i))}
-            for i in data]
+            for i in get_storage().users()]
+
+
+@app.route('/api/v1/data_errors', methods=['GET'])
+@jsonify
+def data_errors_view():
+    """
+    Returns counters and sample line numbers of invalid presence rows.
+    """
+    return get_validation_report()
 
 
 @app.route('/api/v1/presence_start_end/', methods=['GET'])
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
 @jsonify
+@memorize_per_version(storage_version)
 def presence_start_end_view(user_id=None):
     """
     Returns start and end time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    storage = get_storage()
+    if not storage.has_user(user_id):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday_start_end(data[user_id])
+    weekdays = storage.weekday_start_end(user_id)
 
     result = [(
         calendar.day_abbr[weekday],
@@ -84,16 +248,17 @@ def presence_start_end_view(user_id=None):
 @app.route('/api/v1/mean_time_weekday/', methods=['GET'])
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
 @jsonify
+@memorize_per_version(storage_version)
 def mean_time_weekday_view(user_id=None):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    storage = get_storage()
+    if not storage.has_user(user_id):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
+    weekdays = storage.weekday_intervals(user_id)
     result = [(calendar.day_abbr[weekday], mean(intervals))
               for weekday, intervals in weekdays.items()]
 
@@ -103,18 +268,79 @@ def mean_time_weekday_view(user_id=None):
 @app.route('/api/v1/presence_weekday/', methods=['GET'])
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
 @jsonify
+@memorize_per_version(storage_version)
 def presence_weekday_view(user_id=None):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    storage = get_storage()
+    if not storage.has_user(user_id):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
+    weekdays = storage.weekday_intervals(user_id)
     result = [(calendar.day_abbr[weekday], sum(intervals))
               for weekday, intervals in weekdays.items()]
 
     result.insert(0, ('Weekday', 'Presence (s)'))
     return result
+
+
+@app.route('/api/v1/chart/<string:chart>/', methods=['GET'])
+@app.route('/api/v1/chart/<string:chart>/<int:user_id>', methods=['GET'])
+@jsonify
+def chart_view(chart, user_id=None):
+    """
+    Returns chart data of given user as Google DataTable.
+
+    Daily series may be downsampled with `points` query argument.
+    """
+    if chart not in CHARTS:
+        abort(404)
+    points = request.args.get('points', type=int)
+    if points is not None and points < MIN_POINTS:
+        abort(400)
+    if points is None:
+        # same cache entry as charts inlined by dashboard_bootstrap
+        return chart_table(chart, user_id)
+    return chart_table(chart, user_id, points)
+
+
+@app.route('/api/v1/presence_trend/', methods=['GET'])
+@app.route('/api/v1/presence_trend/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_trend_view(user_id=None):
+    """
+    Returns presence of given user summed per ISO week or month.
+
+    `period` query argument is week (default) or month, `start` and
+    `end` limit returned buckets, e.g. ?period=month&start=2013-01.
+    """
+    period = request.args.get('period', 'week')
+    if period not in ROLLUP_PERIODS:
+        abort(400)
+    start = request.args.get('start')
+    end = request.args.get('end')
+    for key in (start, end):
+        if key is not None and not is_rollup_key(period, key):
+            abort(400)
+    return presence_trend(user_id, period, start, end)
+
+
+@memorize_per_version(storage_version)
+def presence_trend(user_id, period, start=None, end=None):
+    """
+    Returns [bucket key, seconds, days] of given user between keys,
+    inclusive.
+    """
+    storage = get_storage()
+    if not storage.has_user(user_id):
+        log.debug('User %s not found!', user_id)
+        return []
+
+    return [
+        bucket
+        for bucket in storage.trend(user_id, period)
+        if (start is None or bucket[0] >= start) and
+        (end is None or bucket[0] <= end)
+    ]
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Cache warm-up run on startup and after presence data reloads.
+"""
+
+import os
+import re
+import threading
+from collections import Counter
+
+from flask import url_for
+
+from presence_analyzer.main import app
+from presence_analyzer import utils, storage
+from presence_analyzer.charts import CHARTS
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# set once data is loaded and most requested responses are cached
+READY = threading.Event()
+
+# started from make_app unless server warms up on its own (prefork, gevent)
+BACKGROUND = {'enabled': True}
+
+WARMUP_HEADERS = (
+    {},
+    {'Accept-Encoding': 'gzip'},
+)
+
+# per-user API and chart urls, e.g. /api/v1/chart/presence_weekday/10
+USER_URL_RE = re.compile(r'"GET /api/v\d+/(?:chart/)?\w+/(\d+)[ ?]')
+
+# access log grows without bound, only its recent part is counted
+ACCESS_LOG_TAIL = 4 * 1024 * 1024
+
+
+def top_users(log_path, limit, tail=ACCESS_LOG_TAIL):
+    """
+    Returns ids of users most often requested according to last `tail`
+    bytes of access log.
+    """
+    counter = Counter()
+    try:
+        with open(log_path, 'rb') as logfile:
+            logfile.seek(0, os.SEEK_END)
+            size = logfile.tell()
+            logfile.seek(max(size - tail, 0))
+            if size > tail:
+                # skip partially read line
+                logfile.readline()
+            for line in logfile:
+                match = USER_URL_RE.search(line)
+                if match:
+                    counter[int(match.group(1))] += 1
+    except IOError:
+        log.debug('Cannot read access log %s', log_path, exc_info=True)
+        return []
+    return [user_id for user_id, _ in counter.most_common(limit)]
+
+
+def warmup_users():
+    """
+    Returns users to warm up, WARMUP_USERS or top users from ACCESS_LOG.
+    """
+    users = app.config.get('WARMUP_USERS')
+    if users:
+        return list(users)
+    log_path = app.config.get('ACCESS_LOG')
+    if not log_path:
+        return []
+    return top_users(
+        log_path,
+        app.config.get('WARMUP_TOP_USERS', 20),
+        app.config.get('WARMUP_LOG_TAIL', ACCESS_LOG_TAIL),
+    )
+
+
+def warm_up():
+    """
+    Loads presence and user data and precomputes charts of dashboards
+    for most requested users. Marks worker as ready afterwards.
+
+    With WARMUP disabled worker is ready as soon as data is loaded.
+    """
+    # loads CSV data, SQLite storage only checks its database
+    storage.storage_version()
+    try:
+        utils.get_user_data()
+    except Exception:  # pylint: disable-msg=W0703
+        log.exception('Loading user data failed')
+
+    if not app.config.get('WARMUP', True):
+        READY.set()
+        return
+
+    users = warmup_users()
+    client = app.test_client()
+    with app.test_request_context():
+        urls = [
+            url_for('chart_view', chart=name, user_id=user_id)
+            for user_id in users
+            for name in sorted(CHARTS)
+        ]
+    for url in urls:
+        for headers in WARMUP_HEADERS:
+            client.get(url, headers=headers)
+
+    READY.set()
+    log.info('Warmed up %d users', len(users))
+
+
+def start(interval, refresh=None):
+    """
+    Warms up in background thread and again after every data reload.
+
+    Also started with WARMUP disabled, to load data and keep it fresh.
+    Data is loaded with `refresh`, storage.refresh_storage by default.
+    """
+    refresh = refresh or storage.refresh_storage
+
+    def _run():
+        try:
+            refresh()
+            warm_up()
+        except Exception:  # pylint: disable-msg=W0703
+            # stays not ready until reloader manages to load data
+            log.exception('Warm-up failed')
+        utils.start_reloader(
+            interval, warm_up, refresh, storage.storage_version,
+        )
+
+    thread = threading.Thread(target=_run, name='presence-warmup')
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+Entry point of gevent server, [server:gevent] in parts/etc/deploy.ini.
+
+Kept outside of presence_analyzer package on purpose: importing the
+package imports socket users and creates locks, so monkey patching has
+to happen before that.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+
+def make_server(global_conf={}, **conf):  # pylint: disable-msg=W0102
+    """
+    Paste server factory, see presence_analyzer.script.make_gevent_server.
+    """
+    from presence_analyzer.script import make_gevent_server
+    return make_gevent_server(global_conf, **conf)